@@ -12,7 +12,12 @@ def extract_pids_and_texts_from_item(item, source_type="matched_texts", source_f
     if source_type == "matched_texts":
         return [(ctx.get("pid", ""), ctx.get("text", ""), source_file, None) for ctx in item.get("matched_texts", [])]
     elif source_type == "ctxs":
-        return [(ctx.get("pid", ""), ctx.get("text", ""), source_file, ctx.get("score", 0.0)) for ctx in item.get("ctxs", [])]
+        # dense inner products and BM25 scores are on different scales, divide both by the question's top score
+        ctxs = item.get("ctxs", [])
+        top_score = max([float(ctx.get("score", 0.0)) for ctx in ctxs], default=0.0)
+        if top_score <= 0:
+            top_score = 1.0
+        return [(ctx.get("pid", ""), ctx.get("text", ""), source_file, float(ctx.get("score", 0.0)) / top_score) for ctx in ctxs]
     else:
         raise ValueError("Unknown source_type")
 
@@ -31,6 +36,9 @@ def calculate_score(block, total_blocks_in_document, max_similarity_score):
 
 def load_json(file_path):
     with open(file_path, 'r', encoding='utf-8') as f:
+        if file_path.endswith('.jsonl'):
+            # retrieval scripts write one question per line
+            return [json.loads(line) for line in f]
         return json.load(f)
 
 file_sources = [
@@ -38,7 +46,9 @@ file_sources = [
     ('', "ctxs"), # Path to retrieval on the text based on the query.
     ('', "ctxs"), # Path to retrieval on the abstract based on the query.
     ('', "ctxs"), # Path to retrieval on the text based on the virtual answer.
-    ('', "ctxs") # Path to retrieval on the abstract based on the virtual answer.
+    ('', "ctxs"), # Path to retrieval on the abstract based on the virtual answer.
+    ('', "ctxs"), # Path to bm25_retrieval.py output on the text based on the query.
+    ('', "ctxs") # Path to bm25_retrieval.py output on the abstract based on the query.
 ]
 
 json_data = [load_json(file_path) for file_path, _ in file_sources]
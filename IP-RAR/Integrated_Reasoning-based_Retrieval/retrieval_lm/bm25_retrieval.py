@@ -0,0 +1,69 @@
+# Sparse BM25 retrieval over a passages file, written in the same format as passage_retrieval.py
+# so that Aggregator.py can combine it with the dense results.
+
+import json
+import time
+import argparse
+
+import src.bm25
+import src.passage_store
+from passage_retrieval import QUERY_FIELDS, load_queries
+
+
+def main(args):
+    index = src.bm25.open_bm25_index(args.passages, args.bm25_index, k1=args.k1, b=args.b, title=args.title)
+    # BM25 documents are numbered by their line in the passages file, as the lines of the store
+    store = src.passage_store.open_passage_store(args.passages)
+    queries = load_queries(args.query, args.query_field)
+
+    start_time_retrieval = time.time()
+    retrieved_results = []
+    for question in queries:
+        docs, scores = index.search(question, args.n_docs)
+        # raw BM25 scores are unbounded; scale them by the query's top score to [0, 1], as
+        # Aggregator.py does for every retrieval source
+        if len(scores) and scores[0] > 0:
+            scores = scores / scores[0]
+        ctxs = []
+        for doc, score in zip(docs.tolist(), scores):
+            passage = store.read_line(doc)
+            ctxs.append({'id': passage['id'], 'pid': passage.get('title', ''), 'text': passage['text'], 'score': str(score)})
+        retrieved_results.append({"question": question, "ctxs": ctxs})
+    print(f"Search time: {time.time()-start_time_retrieval:.1f} s.")
+
+    with open(args.output_dir + '.jsonl', 'w') as jsonl_file:
+        for item in retrieved_results:
+            jsonl_file.write(json.dumps(item) + '\n')
+    print(f"Results written to {args.output_dir}.jsonl")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--query",
+        type=str,
+        default=None,
+        help=".json file containing question and answers, similar format to reader data",
+    )
+    parser.add_argument(
+        "--query_field",
+        type=str,
+        default="question",
+        choices=QUERY_FIELDS,
+        help="Retrieve with the questions of --query or with the virtual answers written by question_analysis.py",
+    )
+    parser.add_argument("--passages", type=str, default=None, help="Path to passages (.tsv file)")
+    parser.add_argument(
+        "--bm25_index", type=str, default=None, help="Directory of the BM25 index, defaults to PASSAGES.bm25"
+    )
+    parser.add_argument(
+        "--output_dir", type=str, default=None, help="Results are written to outputdir with data suffix"
+    )
+    parser.add_argument("--n_docs", type=int, default=100, help="Number of documents to retrieve per questions")
+    parser.add_argument("--k1", type=float, default=0.9, help="BM25 term frequency saturation")
+    parser.add_argument("--b", type=float, default=0.4, help="BM25 document length normalization")
+    parser.add_argument("--title", action="store_true", help="Index the passage title with its text")
+
+    args = parser.parse_args()
+    main(args)
@@ -7,94 +7,213 @@
 import os
 
 import argparse
-import csv
-import logging
-import pickle
+import hashlib
 
 import numpy as np
 import torch
 from tqdm import tqdm
-import transformers
 
 import src.slurm
+import src.dist_utils
 import src.contriever
 import src.utils
 import src.data
+import src.embeddings
+import src.encoding
 import src.normalize_text
 
 
-def embed_passages(args, passages, model, tokenizer):
+def passage_text(args, p):
+    if args.no_title or not "title" in p:
+        text = p["text"]
+    else:
+        text = p["title"] + " " + p["text"]
+    if args.lowercase:
+        text = text.lower()
+    if args.normalize_text:
+        text = src.normalize_text.normalize(text)
+    return text
+
+
+def passage_key(args, p):
+    """Digest of the embedded content and of every setting that changes its embedding.
+
+    The title is part of the key only when it is prepended to the text, so with `--no_title` the
+    same chunk under several pids has one key.
+    """
+    device = args.device or src.contriever.default_device(args.int8)
+    settings = [
+        args.model_name_or_path,
+        f"no_title={args.no_title}",
+        f"lowercase={args.lowercase}",
+        f"normalize_text={args.normalize_text}",
+        f"maxlength={args.passage_maxlength}",
+        f"fp16={not args.no_fp16 and device != 'cpu'}",
+        f"int8={args.int8}",
+    ]
+    title = [] if args.no_title or "title" not in p else [p["title"]]
+    content = "\x1f".join(settings + title + [p["text"]])
+    return hashlib.blake2b(content.encode("utf-8"), digest_size=16).digest()
+
+
+def embed_passages_cached(args, passages, writer, cache):
+    """Encode only passages whose key is missing from `cache`, then write all embeddings from it."""
+    keys = np.array([passage_key(args, p) for p in passages], dtype="S16")
+    missing = cache.lookup(keys) < 0
+    # one encoding per distinct content, even if it appears under several passage ids
+    _, first = np.unique(keys[missing], return_index=True)
+    to_encode = [dict(passages[i], id=keys[i]) for i in np.flatnonzero(missing)[np.sort(first)]]
+    print(f"{len(passages) - missing.sum()} passages found in the embedding cache, encoding {len(to_encode)}.")
+
+    if to_encode:
+        model, tokenizer, _ = src.contriever.load_retriever(args.model_name_or_path)
+        model = src.contriever.prepare_for_inference(model, args.device, fp16=not args.no_fp16, int8=args.int8)
+        embed_passages(args, to_encode, model, tokenizer, cache)
+        cache.flush()
+
+    rows = cache.lookup(keys)
+    for start_idx in range(0, len(passages), args.embeddings_per_file):
+        end_idx = start_idx + args.embeddings_per_file
+        writer.add([p["id"] for p in passages[start_idx:end_idx]], cache.get(rows[start_idx:end_idx]))
+    return len(passages)
+
+
+class PassageWindows(torch.utils.data.Dataset):
+    """Windows of `bucket_window` passages, each normalized, tokenized and batched when loaded.
+
+    Wrapped in a DataLoader with worker processes, the text preprocessing of the next windows
+    runs while the encoder processes the current one.
+    """
+
+    def __init__(self, args, passages, tokenizer):
+        self.args = args
+        self.passages = passages
+        self.tokenizer = tokenizer
+
+    def __len__(self):
+        return (len(self.passages) + self.args.bucket_window - 1) // self.args.bucket_window
+
+    def __getitem__(self, index):
+        window = self.passages[index * self.args.bucket_window:(index + 1) * self.args.bucket_window]
+        batches = src.encoding.make_batches(
+            self.tokenizer,
+            [passage_text(self.args, p) for p in window],
+            self.args.passage_maxlength,
+            self.args.per_gpu_batch_size,
+            max_tokens=self.args.max_tokens_per_batch,
+            sort_by_length=self.args.bucket_by_length,
+        )
+        return [p["id"] for p in window], batches
+
+
+def _no_collate(item):
+    return item
+
+
+def embed_passages(args, passages, model, tokenizer, writer):
     total = 0
-    allids, allembeddings = [], []
-    batch_ids, batch_text = [], []
-    with torch.no_grad():
-        for k, p in tqdm(enumerate(passages)):
-            batch_ids.append(p["id"])
-            if args.no_title or not "title" in p:
-                text = p["text"]
-            else:
-                text = p["title"] + " " + p["text"]
-            if args.lowercase:
-                text = text.lower()
-            if args.normalize_text:
-                text = src.normalize_text.normalize(text)
-            batch_text.append(text)
-
-            if len(batch_text) == args.per_gpu_batch_size or k == len(passages) - 1:
-
-                encoded_batch = tokenizer.batch_encode_plus(
-                    batch_text,
-                    return_tensors="pt",
-                    max_length=args.passage_maxlength,
-                    padding=True,
-                    truncation=True,
-                )
-
-                encoded_batch = {k: v.cuda() for k, v in encoded_batch.items()}
-                embeddings = model(**encoded_batch)
-
-                embeddings = embeddings.cpu()
-                total += len(batch_ids)
-                allids.extend(batch_ids)
-                allembeddings.append(embeddings)
-
-                batch_text = []
-                batch_ids = []
-                if k % 100000 == 0 and k > 0:
-                    print(f"Encoded passages {total}")
-
-    allembeddings = torch.cat(allembeddings, dim=0).numpy()
-    return allids, allembeddings
-
-
-def main(args):
-    model, tokenizer, _ = src.contriever.load_retriever(args.model_name_or_path)
-    print(f"Model loaded from {args.model_name_or_path}.", flush=True)
-    model.eval()
-    model = model.cuda()
-    if not args.no_fp16:
-        model = model.half()
-
-    passages = src.data.load_passages(args.passages)
+    loader = torch.utils.data.DataLoader(
+        PassageWindows(args, passages, tokenizer),
+        batch_size=None,
+        num_workers=args.num_workers,
+        collate_fn=_no_collate,
+    )
+    # windows arrive in order, embeddings are written back in input order
+    for ids, batches in tqdm(loader):
+        embeddings = src.encoding.encode_batches(model, batches, len(ids))
+
+        total += len(ids)
+        writer.add(ids, embeddings)
+        print(f"Encoded passages {total}")
+
+    return total
+
+
+def run_worker(rank, args, byte_ranges):
+    """Embed sub-shard `rank` of `--shard_id`, the records in `byte_ranges[rank]`, in a process started by `launch`."""
+    if args.device is None and not args.int8 and torch.cuda.device_count() > 1:
+        args.device = f"cuda:{rank % torch.cuda.device_count()}"
+    # share the cores between the workers and their DataLoader processes instead of oversubscribing them
+    cores = max(1, os.cpu_count() // args.num_procs)
+    if args.num_workers > 0:
+        args.num_workers = max(1, min(args.num_workers, cores // 2))
+    torch.set_num_threads(max(1, cores - args.num_workers))
+    embed_shard(
+        args,
+        args.shard_id * args.num_procs + rank,
+        args.num_shards * args.num_procs,
+        args.prefix + f"_{args.shard_id:02d}_{rank:02d}",
+        byte_range=byte_ranges[rank],
+    )
 
-    shard_size = len(passages) // args.num_shards
-    start_idx = args.shard_id * shard_size
-    end_idx = start_idx + shard_size
-    if args.shard_id == args.num_shards - 1:
-        end_idx = len(passages)
 
-    passages = passages[start_idx:end_idx]
-    print(f"Embedding generation for {len(passages)} passages from idx {start_idx} to {end_idx}.")
+def launch(args):
+    """Embed `--shard_id` with `--num_procs` worker processes and merge their manifests."""
+    if args.embedding_cache is not None:
+        raise ValueError("--embedding_cache cannot be shared by several --num_procs workers")
+    # record boundaries are found once here, each worker then reads only its own byte range
+    byte_ranges = src.data.shard_byte_ranges(
+        args.passages,
+        args.num_shards * args.num_procs,
+        [args.shard_id * args.num_procs + rank for rank in range(args.num_procs)],
+    )
+    torch.multiprocessing.spawn(run_worker, args=(args, byte_ranges), nprocs=args.num_procs)
+    manifest_paths = [
+        os.path.join(args.output_dir, args.prefix + f"_{args.shard_id:02d}_{rank:02d}.json")
+        for rank in range(args.num_procs)
+    ]
+    output_path = os.path.join(args.output_dir, args.prefix + f"_{args.shard_id:02d}.json")
+    merged = src.embeddings.merge_manifests(manifest_paths, output_path)
+    print(f"Total passages processed {merged['total']} by {args.num_procs} workers. Written to {output_path}.")
 
-    allids, allembeddings = embed_passages(args, passages, model, tokenizer)
 
-    save_file = os.path.join(args.output_dir, args.prefix + f"_{args.shard_id:02d}")
-    os.makedirs(args.output_dir, exist_ok=True)
-    print(f"Saving {len(allids)} passage embeddings to {save_file}.")
-    with open(save_file, mode="wb") as f:
-        pickle.dump((allids, allembeddings), f)
+def main(args):
+    if args.world_size > 1:
+        # every rank of a distributed job embeds one shard, rank 0 merges the shard manifests
+        args.shard_id, args.num_shards = args.global_rank, args.world_size
+    if args.num_procs > 1:
+        launch(args)
+    else:
+        embed_shard(args, args.shard_id, args.num_shards, args.prefix + f"_{args.shard_id:02d}")
+
+    if args.world_size > 1:
+        src.dist_utils.barrier()
+        if src.dist_utils.is_main():
+            manifest_paths = [
+                os.path.join(args.output_dir, args.prefix + f"_{shard_id:02d}.json") for shard_id in range(args.world_size)
+            ]
+            output_path = os.path.join(args.output_dir, args.prefix + ".json")
+            merged = src.embeddings.merge_manifests(manifest_paths, output_path)
+            print(f"Total passages processed {merged['total']} by {args.world_size} ranks. Written to {output_path}.")
+
+
+def embed_shard(args, shard_id, num_shards, prefix, byte_range=None):
+    if args.num_workers > 0:
+        # tokenization is parallelized across worker processes instead
+        os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+    passages = src.data.load_passages(args.passages, shard_id, num_shards, byte_range)
+    print(f"Embedding generation for {len(passages)} passages of shard {shard_id} of {num_shards}.")
+
+    writer = src.embeddings.EmbeddingWriter(
+        args.output_dir,
+        prefix,
+        args.embeddings_per_file,
+        expected_total=len(passages),
+        resume=args.resume,
+    )
+    if writer.total > 0:
+        print(f"Skipping {writer.total} passages already written.")
+    if args.embedding_cache is not None:
+        cache = src.embeddings.EmbeddingCache(args.embedding_cache, args.embeddings_per_file)
+        embed_passages_cached(args, passages[writer.total:], writer, cache)
+    else:
+        model, tokenizer, _ = src.contriever.load_retriever(args.model_name_or_path)
+        print(f"Model loaded from {args.model_name_or_path}.", flush=True)
+        model = src.contriever.prepare_for_inference(model, args.device, fp16=not args.no_fp16, int8=args.int8)
+        embed_passages(args, passages[writer.total:], model, tokenizer, writer)
+    writer.close()
 
-    print(f"Total passages processed {len(allids)}. Written to {save_file}.")
+    print(f"Total passages processed {writer.total}. Written to {writer.manifest_path}.")
 
 
 if __name__ == "__main__":
@@ -105,14 +224,72 @@ if __name__ == "__main__":
     parser.add_argument("--prefix", type=str, default="passages", help="prefix path to save embeddings")
     parser.add_argument("--shard_id", type=int, default=0, help="Id of the current shard")
     parser.add_argument("--num_shards", type=int, default=1, help="Total number of shards")
+    parser.add_argument(
+        "--num_procs",
+        type=int,
+        default=1,
+        help="Number of worker processes embedding the shard in parallel, each reading its own part of the file",
+    )
     parser.add_argument(
         "--per_gpu_batch_size", type=int, default=512, help="Batch size for the passage encoder forward pass"
     )
+    parser.add_argument(
+        "--embeddings_per_file", type=int, default=50000, help="Number of embeddings written to each .npy file"
+    )
+    parser.add_argument(
+        "--embedding_cache",
+        type=str,
+        default=None,
+        help="Directory of embeddings keyed by passage content; only passages missing from it are encoded",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue from the last embedding file recorded in the output manifest instead of starting over",
+    )
+    parser.add_argument(
+        "--bucket_by_length",
+        action="store_true",
+        help="Batch passages of similar token length together to reduce padding",
+    )
+    parser.add_argument(
+        "--max_tokens_per_batch",
+        type=int,
+        default=0,
+        help="Token budget of a padded batch, batches hold at most per_gpu_batch_size passages; 0 disables",
+    )
+    parser.add_argument(
+        "--bucket_window", type=int, default=16384, help="Number of passages tokenized and bucketed together"
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=4,
+        help="Number of DataLoader worker processes preparing passage batches, 0 tokenizes in the main process; "
+        "with --num_procs, each process uses at most half of its share of the cores",
+    )
     parser.add_argument("--passage_maxlength", type=int, default=512, help="Maximum number of tokens in a passage")
     parser.add_argument(
         "--model_name_or_path", type=str, help="path to directory containing model weights and config file"
     )
     parser.add_argument("--no_fp16", action="store_true", help="inference in fp32")
+    parser.add_argument(
+        "--device", type=str, default=None, help="Device used for encoding, defaults to cuda if available else cpu"
+    )
+    parser.add_argument(
+        "--int8", action="store_true", help="Encode on cpu with int8 dynamic quantization of the linear layers"
+    )
+    parser.add_argument(
+        "--local_rank", type=int, default=int(os.environ.get("LOCAL_RANK", -1)), help="For distributed training: local_rank"
+    )
+    parser.add_argument("--main_port", type=int, default=-1, help="Main port (for multi-node SLURM jobs)")
+    parser.add_argument(
+        "--dist_backend",
+        type=str,
+        default=None,
+        choices=["nccl", "gloo"],
+        help="torch.distributed backend, defaults to nccl with cuda and gloo otherwise",
+    )
     parser.add_argument("--no_title", action="store_true", help="title not added to the passage body")
     parser.add_argument("--lowercase", action="store_true", help="lowercase text before encoding")
     parser.add_argument("--normalize_text", action="store_true", help="lowercase text before encoding")
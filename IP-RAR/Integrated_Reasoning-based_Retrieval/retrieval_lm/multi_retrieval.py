@@ -0,0 +1,82 @@
+# Run several retrievals in one process: the model, each index and each passage file are loaded
+# once, and the questions and virtual answers of all runs are embedded in a single pass.
+
+import numpy as np
+
+import src.slurm
+import src.dist_utils
+import src.index
+from passage_retrieval import Retriever, QUERY_FIELDS, get_parser, load_queries
+
+
+def main(args):
+    runs = []
+    for query_field, passages, passages_embeddings, output_dir, n_docs in args.run:
+        if query_field not in QUERY_FIELDS:
+            raise ValueError(f"Unknown query field {query_field}, expected one of {QUERY_FIELDS}")
+        runs.append((query_field, passages, passages_embeddings, output_dir, int(n_docs)))
+
+    model_retriever = Retriever(args)
+    model_retriever.setup_model()
+
+    queries = {field: load_queries(args.query, field) for field in sorted({run[0] for run in runs})}
+    texts = list(dict.fromkeys(text for field_queries in queries.values() for text in field_queries))
+    embeddings = {}
+
+    def embed(batch_texts):
+        # the first search embeds every distinct query text of all fields at once
+        if not embeddings:
+            embeddings.update(zip(texts, model_retriever.embed_queries(args, texts)))
+        return np.stack([embeddings[text] for text in batch_texts])
+
+    passage_maps = {}
+    for (passages, passages_embeddings), index_runs in group_runs(runs).items():
+        retriever = Retriever(args, model_retriever.model, model_retriever.tokenizer)
+        retriever.setup_index(passages_embeddings, passages)
+        if passages not in passage_maps:
+            retriever.setup_passages(passages)
+            passage_maps[passages] = getattr(retriever, "passage_id_map", None)
+        retriever.passage_id_map = passage_maps[passages]
+
+        # one search per index, at the largest n_docs of its runs
+        fields = list(dict.fromkeys(run[0] for run in index_runs))
+        index_queries = [text for field in fields for text in queries[field]]
+        n_docs = max(run[4] for run in index_runs)
+        print(f"Searching {passages_embeddings}")
+        top_ids_and_scores = retriever.search_queries(index_queries, n_docs, embed)
+        if not src.dist_utils.is_main():
+            continue
+
+        offsets = np.cumsum([0] + [len(queries[field]) for field in fields])
+        for query_field, _, _, output_dir, run_n_docs in index_runs:
+            start = offsets[fields.index(query_field)]
+            end = start + len(queries[query_field])
+            run_results = src.index.SearchResults(
+                top_ids_and_scores.ids[start:end, :run_n_docs],
+                top_ids_and_scores.scores[start:end, :run_n_docs],
+                top_ids_and_scores.indexes[start:end, :run_n_docs],
+            )
+            retriever.write_results(queries[query_field], run_results, output_dir)
+            print(f"Retrieved {query_field} from {passages_embeddings}, written to {output_dir}.jsonl")
+
+
+def group_runs(runs):
+    groups = {}
+    for run in runs:
+        groups.setdefault((run[1], run[2]), []).append(run)
+    return groups
+
+
+if __name__ == "__main__":
+    parser = get_parser()
+    parser.add_argument(
+        "--run",
+        nargs=5,
+        action="append",
+        required=True,
+        metavar=("QUERY_FIELD", "PASSAGES", "PASSAGES_EMBEDDINGS", "OUTPUT", "N_DOCS"),
+        help="One retrieval: query field of --query, passages tsv, embeddings glob or manifest, output file, n_docs",
+    )
+    args = parser.parse_args()
+    src.slurm.init_distributed_mode(args)
+    main(args)
@@ -7,9 +7,7 @@
 import os
 import argparse
 import json
-import pickle
 import time
-import glob
 from pathlib import Path
 
 import numpy as np
@@ -17,10 +15,17 @@ import torch
 import transformers
 
 import src.index
+import src.embeddings
+import src.encoding
 import src.contriever
 import src.utils
 import src.slurm
+import src.dist_utils
 import src.data
+import src.passage_store
+import src.cache
+import src.cascade
+import src.papers
 import src.normalize_text
 
 os.environ["TOKENIZERS_PARALLELISM"] = "true"
@@ -31,36 +36,55 @@ class Retriever:
         self.args = args
         self.model = model
         self.tokenizer = tokenizer
+        self.query_cache = None
+        self.result_cache = None
+        self.id_selector = None
+        self.paper_lookup = None
+        self.mmr_embeddings = None
+        # per-search progress messages, turned off by the retrieval server
+        self.verbose = True
+
+    def log(self, message):
+        if self.verbose:
+            print(message)
 
     def embed_queries(self, args, queries):
-        embeddings, batch_question = [], []
-        with torch.no_grad():
-            for k, q in enumerate(queries):
-                if args.lowercase:
-                    q = q.lower()
-                if args.normalize_text:
-                    q = src.normalize_text.normalize(q)
-                batch_question.append(q)
-
-                if len(batch_question) == args.per_gpu_batch_size or k == len(queries) - 1:
-
-                    encoded_batch = self.tokenizer.batch_encode_plus(
-                        batch_question,
-                        return_tensors="pt",
-                        max_length=args.question_maxlength,
-                        padding=True,
-                        truncation=True,
-                    )
-                    encoded_batch = {k: v.cuda() for k, v in encoded_batch.items()}
-                    output = self.model(**encoded_batch)
-                    embeddings.append(output.cpu())
-
-                    batch_question = []
-
-        embeddings = torch.cat(embeddings, dim=0)
-        print(f"Questions embeddings shape: {embeddings.size()}")
-
-        return embeddings.numpy()
+        batch_question = []
+        for q in queries:
+            if args.lowercase:
+                q = q.lower()
+            if args.normalize_text:
+                q = src.normalize_text.normalize(q)
+            batch_question.append(q)
+
+        if self.query_cache is None:
+            embeddings = self.encode_queries(args, batch_question)
+        else:
+            keys = self.query_cache.keys(batch_question)
+            cached = self.query_cache.get_many(keys)
+            missing = [i for i, key in enumerate(keys) if key not in cached]
+            self.log(f"{len(keys) - len(missing)} of {len(keys)} question embeddings found in the cache")
+            # the model only runs for questions that are not cached
+            if missing:
+                missing_keys = [keys[i] for i in missing]
+                missing_embeddings = self.encode_queries(args, [batch_question[i] for i in missing])
+                self.query_cache.put_many(missing_keys, missing_embeddings)
+                cached.update(zip(missing_keys, missing_embeddings))
+            embeddings = np.stack([cached[key] for key in keys])
+        self.log(f"Questions embeddings shape: {embeddings.shape}")
+
+        return embeddings
+
+    def encode_queries(self, args, batch_question):
+        batches = src.encoding.make_batches(
+            self.tokenizer,
+            batch_question,
+            args.question_maxlength,
+            args.per_gpu_batch_size,
+            max_tokens=args.max_tokens_per_batch,
+            sort_by_length=args.bucket_by_length,
+        )
+        return src.encoding.encode_batches(self.model, batches, len(batch_question))
     
 
     def embed_queries_demo(self, queries):
@@ -78,7 +102,8 @@ class Retriever:
                         padding=True,
                         truncation=True,
                     )
-                    encoded_batch = {k: v.cuda() for k, v in encoded_batch.items()}
+                    device = next(self.model.parameters()).device
+                    encoded_batch = {k: v.to(device) for k, v in encoded_batch.items()}
                     output = self.model(**encoded_batch)
                     embeddings.append(output.cpu())
 
@@ -89,101 +114,358 @@ class Retriever:
 
         return embeddings.numpy()
 
+    def train_index(self, index, embedding_files):
+        # draw n_train rows over all files rather than from the first indexing batch; files get a share
+        # proportional to their size, and only the sampled rows are read from the memory-mapped parts
+        rng = np.random.default_rng(index.seed)
+        embeddings = src.embeddings.EmbeddingFiles(embedding_files)
+        rows = np.sort(rng.choice(len(embeddings), min(index.n_train, len(embeddings)), replace=False))
+        index.train(embeddings.rows(rows))
+
     def index_encoded_data(self, index, embedding_files, indexing_batch_size):
-        allids = []
-        allembeddings = np.array([])
-        for i, file_path in enumerate(embedding_files):
+        if not index.is_trained:
+            self.train_index(index, embedding_files)
+        for file_path in embedding_files:
             print(f"Loading file {file_path}")
-            with open(file_path, "rb") as fin:
-                ids, embeddings = pickle.load(fin)
-
-            allembeddings = np.vstack((allembeddings, embeddings)) if allembeddings.size else embeddings
-            allids.extend(ids)
-            while allembeddings.shape[0] > indexing_batch_size:
-                allembeddings, allids = self.add_embeddings(index, allembeddings, allids, indexing_batch_size)
-
-        while allembeddings.shape[0] > 0:
-            allembeddings, allids = self.add_embeddings(index, allembeddings, allids, indexing_batch_size)
+            # .npy parts are memory-mapped, slices are handed to faiss without copies
+            ids, embeddings = src.embeddings.load_embeddings(file_path)
+            for start_idx in range(0, len(ids), indexing_batch_size):
+                end_idx = start_idx + indexing_batch_size
+                index.index_data(ids[start_idx:end_idx], embeddings[start_idx:end_idx])
 
         print("Data indexing completed.")
 
-
-    def add_embeddings(self, index, embeddings, ids, indexing_batch_size):
-        end_idx = min(indexing_batch_size, embeddings.shape[0])
-        ids_toadd = ids[:end_idx]
-        embeddings_toadd = embeddings[:end_idx]
-        ids = ids[end_idx:]
-        embeddings = embeddings[end_idx:]
-        index.index_data(ids_toadd, embeddings_toadd)
-        return embeddings, ids
-
-
     def add_passages(self, passages, top_passages_and_scores):
         # add passages to original data
-        docs = [passages[doc_id] for doc_id in top_passages_and_scores[0][0]]
+        valid = top_passages_and_scores.valid[0]
+        docs = [passages[doc_id] for doc_id in top_passages_and_scores.ids[0][valid].tolist()]
         return docs
 
     def setup_retriever(self):
+        self.setup_model()
+        self.setup_index(self.args.passages_embeddings, self.args.passages)
+        self.setup_passages(self.args.passages)
+
+    def setup_model(self):
         print(f"Loading model from: {self.args.model_name_or_path}")
         self.model, self.tokenizer, _ = src.contriever.load_retriever(self.args.model_name_or_path)
-        self.model.eval()
-        self.model = self.model.cuda()
-        if not self.args.no_fp16:
-            self.model = self.model.half()
-
-        self.index = src.index.Indexer(self.args.projection_size, self.args.n_subquantizers, self.args.n_bits)
+        self.model = src.contriever.prepare_for_inference(
+            self.model, self.args.device, fp16=not self.args.no_fp16, int8=self.args.int8
+        )
+        if self.args.query_cache is not None:
+            self.query_cache = src.cache.QueryEmbeddingCache(
+                self.args.query_cache, self.query_settings(), self.args.query_cache_size_mb
+            )
+
+    def query_settings(self):
+        """Settings that change the embedding of a question."""
+        device = self.args.device or src.contriever.default_device(self.args.int8)
+        return [
+            self.args.model_name_or_path,
+            f"lowercase={self.args.lowercase}",
+            f"normalize_text={self.args.normalize_text}",
+            f"maxlength={self.args.question_maxlength}",
+            f"fp16={not self.args.no_fp16 and device != 'cpu'}",
+            f"int8={self.args.int8}",
+        ]
+
+    def setup_index(self, passages_embeddings, passages=None):
+        if self.args.distinct_papers:
+            self.paper_lookup = src.papers.PaperLookup(passages or self.args.passages)
+        if self.args.cascade_papers > 0:
+            self.setup_cascade(passages_embeddings, passages or self.args.passages)
+            return
+        self.index = src.index.Indexer(
+            self.args.projection_size,
+            self.args.n_subquantizers,
+            self.args.n_bits,
+            index_type=self.args.index_type,
+            n_list=self.args.n_list,
+            hnsw_m=self.args.hnsw_m,
+            ef_construction=self.args.ef_construction,
+            n_train=self.args.n_train,
+            explicit_ids=self.args.explicit_ids,
+            refine_k_factor=self.args.refine_k_factor,
+        )
 
         # index all passages
-        input_paths = glob.glob(self.args.passages_embeddings)
-        input_paths = sorted(input_paths)
-        embeddings_dir = os.path.dirname(input_paths[0])
-        index_path = os.path.join(embeddings_dir, "index.faiss")
+        input_paths = src.embeddings.glob_embedding_files(passages_embeddings)
+        index_dir = os.path.dirname(input_paths[0])
+        world_size, rank = src.dist_utils.get_world_size(), src.dist_utils.get_rank()
+        if self.args.mmr_candidates > 0:
+            if self.args.mmr_vectors == "embeddings":
+                self.mmr_embeddings = src.embeddings.EmbeddingFiles(input_paths)
+            elif world_size > 1:
+                raise ValueError("--mmr_vectors index is not supported in distributed mode, use --mmr_vectors embeddings")
+        if world_size > 1:
+            # each rank indexes its own share of the embedding files
+            if len(input_paths) < world_size:
+                raise ValueError(f"{len(input_paths)} embedding files cannot be split between {world_size} ranks")
+            input_paths = np.array_split(input_paths, world_size)[rank].tolist()
+            index_dir = os.path.join(index_dir, f"index_{rank:02d}_of_{world_size:02d}")
+        index_path = os.path.join(index_dir, "index.faiss")
         if self.args.save_or_load_index and os.path.exists(index_path):
-            self.index.deserialize_from(embeddings_dir)
+            self.index.deserialize_from(index_dir, mmap=self.args.mmap_index)
         else:
             print(f"Indexing passages from files {input_paths}")
             start_time_indexing = time.time()
             self.index_encoded_data(self.index, input_paths, self.args.indexing_batch_size)
             print(f"Indexing time: {time.time()-start_time_indexing:.1f} s.")
             if self.args.save_or_load_index:
-                self.index.serialize(embeddings_dir)
-
-        # load passages
-        print("loading passages")
-        self.passages = src.data.load_passages(self.args.passages)
-        self.passage_id_map = {x["id"]: x for x in self.passages}
-        print("passages have been loaded")
+                os.makedirs(index_dir, exist_ok=True)
+                self.index.serialize(index_dir)
+        self.index.set_search_params(
+            nprobe=self.args.nprobe, ef_search=self.args.ef_search, refine_k_factor=self.args.refine_k_factor or None
+        )
+        if self.args.refine_k_factor > 0:
+            # exact vectors are read from the memory-mapped embedding files, only for the candidates
+            self.index.set_refine_vectors(src.embeddings.EmbeddingFiles(input_paths))
+        filter_files = [path for path in (self.args.filter_pids, self.args.paper_metadata) if path is not None]
+        if self.args.filter_pids is not None or self.args.min_year is not None or self.args.max_year is not None:
+            self.setup_filter(passages or self.args.passages)
+
+        if self.args.result_cache is not None:
+            if world_size > 1:
+                raise ValueError("--result_cache is not supported in distributed mode")
+            index_files = [os.path.join(index_dir, name) for name in ("index.faiss", "index_meta.npy", "index_delta.log")]
+            # results change with the embeddings, the saved index and its updates, and the index settings
+            self.index_settings = [
+                src.cache.file_fingerprint(input_paths + index_files + filter_files),
+                f"save_or_load_index={self.args.save_or_load_index}",
+            ] + [
+                f"{name}={getattr(self.args, name)}"
+                for name in ("projection_size", "n_subquantizers", "n_bits", "index_type", "n_list", "hnsw_m",
+                             "ef_construction", "n_train", "refine_k_factor", "nprobe", "ef_search", "min_year",
+                             "max_year", "distinct_papers", "chunks_per_paper", "mmr_candidates", "mmr_lambda",
+                             "mmr_vectors")
+            ]
+            self.result_cache = src.cache.ResultCache(self.args.result_cache, self.args.result_cache_size_mb)
+
+    def setup_cascade(self, passages_embeddings, passages):
+        """Search the `cascade_papers` best papers, then only their chunks, instead of a faiss index."""
+        if src.dist_utils.get_world_size() > 1:
+            raise ValueError("--cascade_papers is not supported in distributed mode")
+        if self.args.filter_pids is not None or self.args.min_year is not None or self.args.max_year is not None:
+            raise ValueError("--filter_pids, --min_year and --max_year are not supported with --cascade_papers")
+        input_paths = src.embeddings.glob_embedding_files(passages_embeddings)
+        paper_paths = None
+        if self.args.paper_embeddings is not None:
+            paper_paths = src.embeddings.glob_embedding_files(self.args.paper_embeddings)
+        self.index = src.cascade.open_cascade(
+            input_paths, passages, self.args.cascade_papers, paper_paths, self.args.paper_passages
+        )
+        if self.args.result_cache is not None:
+            self.index_settings = [
+                src.cache.file_fingerprint(input_paths + [passages] + (paper_paths or []) + [self.args.paper_passages or ""]),
+                f"cascade_papers={self.args.cascade_papers}",
+                f"distinct_papers={self.args.distinct_papers}",
+                f"chunks_per_paper={self.args.chunks_per_paper}",
+                f"mmr_candidates={self.args.mmr_candidates}",
+                f"mmr_lambda={self.args.mmr_lambda}",
+            ]
+            self.result_cache = src.cache.ResultCache(self.args.result_cache, self.args.result_cache_size_mb)
+
+    def setup_filter(self, passages):
+        """Restrict searches to the chunks of --filter_pids papers published between --min_year and --max_year."""
+        years = None
+        if self.args.min_year is not None or self.args.max_year is not None:
+            if self.args.paper_metadata is None:
+                raise ValueError("--min_year and --max_year require --paper_metadata")
+            years = src.papers.load_paper_years(self.args.paper_metadata)
+        allowed_pids = None
+        if self.args.filter_pids is not None:
+            allowed_pids = src.papers.load_pid_list(self.args.filter_pids)
+        passage_ids, pids = src.papers.load_passage_pids(passages)
+        selected = src.papers.select_papers(pids, allowed_pids, years, self.args.min_year, self.args.max_year)
+        print(f"Searching {selected.sum()} of {len(passage_ids)} passages that pass the paper filter")
+        # applied inside faiss, so every search returns n_docs hits that pass the filter
+        self.id_selector = self.index.make_id_selector(passage_ids[selected])
+
+    def setup_passages(self, passages):
+        # only the main rank writes results
+        if src.dist_utils.is_main():
+            print("loading passages")
+            if self.args.passage_store:
+                # passages are read from disk when they are retrieved
+                self.passages = self.passage_id_map = src.passage_store.open_passage_store(passages)
+            else:
+                self.passages = src.data.load_passages(passages)
+                self.passage_id_map = {x["id"]: x for x in self.passages}
+            print("passages have been loaded")
+
+    def search_knn(self, questions_embedding, n_docs):
+        """Search the index; in distributed mode, merge the top `n_docs` of every rank.
+
+        With --distinct_papers, `n_docs` counts papers, see `search_distinct_papers`. With
+        --mmr_candidates, the hits are picked from that many candidates by `search_mmr`.
+        """
+        if self.args.mmr_candidates > 0:
+            return self.search_mmr(questions_embedding, n_docs)
+        return self.search_candidates(questions_embedding, n_docs)
+
+    def search_candidates(self, questions_embedding, n_docs):
+        if self.paper_lookup is not None:
+            return self.search_distinct_papers(questions_embedding, n_docs, self.args.chunks_per_paper)
+        return self.search_chunks(questions_embedding, n_docs)
+
+    def search_mmr(self, questions_embedding, n_docs):
+        """Pick a diverse top `n_docs` from the top --mmr_candidates hits by maximal marginal relevance.
+
+        Relevance is the search score of a candidate; candidate vectors, for the redundancy term, are
+        reconstructed from the index, or read from the embedding files with --mmr_vectors embeddings.
+        Hits keep their search scores.
+        """
+        candidates = self.search_candidates(questions_embedding, max(n_docs, self.args.mmr_candidates))
+        width = n_docs * (self.args.chunks_per_paper if self.paper_lookup is not None else 1)
+        ids = np.full((len(candidates), width), "", dtype=candidates.ids.dtype)
+        scores = np.full((len(candidates), width), -np.inf, dtype="float32")
+        indexes = np.full((len(candidates), width), -1, dtype="int64")
+        costs = []
+        for q_i in range(len(candidates)):
+            start_time = time.time()
+            valid = np.flatnonzero(candidates.valid[q_i])
+            if self.mmr_embeddings is not None:
+                vectors = self.mmr_embeddings.get(candidates.ids[q_i][valid])
+            else:
+                vectors = self.index.reconstruct(candidates.indexes[q_i][valid])
+            relevance = candidates.scores[q_i][valid]
+            selected = valid[mmr_select(relevance, vectors, width, self.args.mmr_lambda)]
+            ids[q_i, : len(selected)] = candidates.ids[q_i][selected]
+            scores[q_i, : len(selected)] = candidates.scores[q_i][selected]
+            indexes[q_i, : len(selected)] = candidates.indexes[q_i][selected]
+            costs.append(time.time() - start_time)
+        if costs:
+            p50, p95, p100 = 1000 * np.percentile(costs, [50, 95, 100])
+            self.log(f"MMR over {candidates.ids.shape[1]} candidates, added latency per question: "
+                     f"p50 {p50:.2f} ms, p95 {p95:.2f} ms, max {p100:.2f} ms")
+        return src.index.SearchResults(ids, scores, indexes)
+
+    def search_chunks(self, questions_embedding, n_docs):
+        if self.id_selector is not None:
+            top_ids_and_scores = self.index.search_knn(questions_embedding, n_docs, id_selector=self.id_selector)
+        else:
+            top_ids_and_scores = self.index.search_knn(questions_embedding, n_docs)
+        if src.dist_utils.get_world_size() > 1:
+            top_ids_and_scores = gather_search_results(top_ids_and_scores, n_docs)
+        return top_ids_and_scores
+
+    def search_distinct_papers(self, questions_embedding, n_papers, chunks_per_paper=1):
+        """Return the best `chunks_per_paper` chunks of each of the top `n_papers` distinct papers.
+
+        Chunks are fetched `--paper_overfetch` times more than needed, and the fetch is doubled for
+        the questions whose hits do not yet hold the chunks to return, until the index runs out of hits.
+        """
+        width = n_papers * chunks_per_paper
+        ids = np.full((len(questions_embedding), width), "", dtype=object)
+        scores = np.full((len(questions_embedding), width), -np.inf, dtype="float32")
+        indexes = np.full((len(questions_embedding), width), -1, dtype="int64")
+        pending = np.arange(len(questions_embedding))
+        n_fetch = width * max(1, self.args.paper_overfetch)
+        while len(pending) > 0:
+            hits = self.search_chunks(questions_embedding[pending], n_fetch)
+            codes = np.where(hits.valid, self.paper_lookup.codes_of(np.where(hits.valid, hits.ids, "")), -1)
+            unfilled = []
+            for row, q_i in enumerate(pending):
+                keep, complete = src.papers.distinct_paper_hits(
+                    codes[row], n_papers, chunks_per_paper, self.paper_lookup.sizes
+                )
+                if not complete and hits.valid[row].all():
+                    unfilled.append(q_i)
+                    continue
+                ids[q_i, : len(keep)] = hits.ids[row][keep]
+                scores[q_i, : len(keep)] = hits.scores[row][keep]
+                indexes[q_i, : len(keep)] = hits.indexes[row][keep]
+            self.log(f"Fetched {n_fetch} chunks for {len(pending)} questions, {len(unfilled)} need more")
+            pending = np.array(unfilled, dtype="int64")
+            n_fetch *= 2
+        return src.index.SearchResults(ids.astype(str), scores, indexes)
+
+    def search_queries(self, queries, n_docs, embed=None):
+        """Embed `queries` with `embed` (default `embed_queries`) and search the index.
+
+        With a result cache, queries whose results are cached for this index are neither embedded
+        nor searched.
+        """
+        embed = embed or (lambda texts: self.embed_queries(self.args, texts))
+        if self.result_cache is None:
+            questions_embedding = embed(queries)
+            start_time_retrieval = time.time()
+            top_ids_and_scores = self.search_knn(questions_embedding, n_docs)
+            self.log(f"Search time: {time.time()-start_time_retrieval:.1f} s.")
+            return top_ids_and_scores
+
+        keys = self.result_keys(queries, n_docs)
+        cached = self.result_cache.get_many(keys)
+        missing = [i for i, key in enumerate(keys) if key not in cached]
+        self.log(f"{len(keys) - len(missing)} of {len(keys)} search results found in the cache")
+        if missing:
+            questions_embedding = embed([queries[i] for i in missing])
+            start_time_retrieval = time.time()
+            top_ids_and_scores = self.search_knn(questions_embedding, n_docs)
+            self.log(f"Search time: {time.time()-start_time_retrieval:.1f} s.")
+            missing_keys = [keys[i] for i in missing]
+            rows = list(zip(top_ids_and_scores.ids, top_ids_and_scores.scores, top_ids_and_scores.indexes))
+            self.result_cache.put_many(missing_keys, rows)
+            cached.update(zip(missing_keys, rows))
+        ids, scores, indexes = zip(*[cached[key] for key in keys])
+        return src.index.SearchResults(np.stack(ids), np.stack(scores), np.stack(indexes))
+
+    def result_keys(self, queries, n_docs):
+        """Keys of the `n_docs` search results of `queries` in the result cache."""
+        return self.result_cache.keys(self.query_settings() + self.index_settings + [f"n_docs={n_docs}"], queries)
+
+    def check_int8_overlap(self, queries):
+        """Compare retrieval with the int8 model against the fp32 model on `queries`."""
+        reference = Retriever(self.args)
+        reference.model, reference.tokenizer, _ = src.contriever.load_retriever(self.args.model_name_or_path)
+        reference.model = src.contriever.prepare_for_inference(reference.model, "cpu", fp16=False)
+
+        top_int8 = self.index.search_knn(self.embed_queries(self.args, queries), self.args.n_docs).ids
+        top_fp32 = self.index.search_knn(reference.embed_queries(self.args, queries), self.args.n_docs).ids
+        overlap = np.mean([len(set(a) & set(b)) / self.args.n_docs for a, b in zip(top_int8.tolist(), top_fp32.tolist())])
+        print(f"int8 top-{self.args.n_docs} overlap with fp32 on {len(queries)} queries: {overlap:.3f}")
+        if overlap < self.args.int8_min_overlap:
+            raise ValueError(
+                f"int8 top-k overlap {overlap:.3f} is below --int8_min_overlap {self.args.int8_min_overlap}"
+            )
+        return overlap
 
     def search_document(self, query, top_n=10):
-        if '.json' in query:
-            all_QA = json.load(open(query))
-            queries = [qa['question'] for qa in all_QA]
-            questions_embedding = self.embed_queries(self.args, queries)
-        else:
-            questions_embedding = self.embed_queries(self.args, [query])
+        queries = load_queries(query, self.args.query_field)
 
         # get top k results
-        start_time_retrieval = time.time()
-        top_ids_and_scores = self.index.search_knn(questions_embedding, self.args.n_docs)
-        print(f"Search time: {time.time()-start_time_retrieval:.1f} s.")
+        top_ids_and_scores = self.search_queries(queries, self.args.n_docs)
+        if not src.dist_utils.is_main():
+            return []
+        self.write_results(queries, top_ids_and_scores, self.args.output_dir)
+
+        return self.add_passages(self.passage_id_map, top_ids_and_scores)[:top_n]
 
+    def write_results(self, queries, top_ids_and_scores, output_dir):
         # save into output_dir
         retrieved_results = []
         # "question", "answer", "ctxs"
-        for q_i, (question, top_id_score) in enumerate(zip(queries, top_ids_and_scores)):
+        for q_i, question in enumerate(queries):
             result = {
                 "question": question,
             }
-            result['ctxs'] = [{'id': top_id_score[0][s_i], 'text': self.passage_id_map[top_id_score[0][s_i]]['text'], 'score': str(top_id_score[1][s_i])} for s_i in range(len(top_id_score[0]))]
+            result['ctxs'] = self.make_ctxs(top_ids_and_scores, q_i)
             retrieved_results.append(result)
 
-        with open(args.output_dir+'.jsonl', 'w') as jsonl_file:
+        with open(output_dir+'.jsonl', 'w') as jsonl_file:
             for item in retrieved_results:
                 jsonl_file.write(json.dumps(item) + '\n')
-            
-
-        return self.add_passages(self.passage_id_map, top_ids_and_scores)[:top_n]
     
+    def make_ctxs(self, top_ids_and_scores, q_i, n_docs=None):
+        valid = top_ids_and_scores.valid[q_i][:n_docs]
+        doc_ids = top_ids_and_scores.ids[q_i][:n_docs][valid].tolist()
+        scores = top_ids_and_scores.scores[q_i][:n_docs][valid]
+        passages = [self.passage_id_map[doc_id] for doc_id in doc_ids]
+        return [
+            {'id': doc_id, 'pid': passage.get('title', ''), 'text': passage['text'], 'score': str(score)}
+            for doc_id, passage, score in zip(doc_ids, passages, scores)
+        ]
+
     def search_document_demo(self, query, n_docs=10):
         questions_embedding = self.embed_queries_demo([query])
 
@@ -194,17 +476,15 @@ class Retriever:
 
         return self.add_passages(self.passage_id_map, top_ids_and_scores)[:n_docs]
 
-    def setup_retriever_demo(self, model_name_or_path, passages, passages_embeddings, n_docs=5, save_or_load_index=False):
+    def setup_retriever_demo(self, model_name_or_path, passages, passages_embeddings, n_docs=5, save_or_load_index=False, device=None):
         print(f"Loading model from: {model_name_or_path}")
         self.model, self.tokenizer, _ = src.contriever.load_retriever(model_name_or_path)
-        self.model.eval()
-        self.model = self.model.cuda()
+        self.model = src.contriever.prepare_for_inference(self.model, device, fp16=False)
 
         self.index = src.index.Indexer(768, 0, 8)
 
         # index all passages
-        input_paths = glob.glob(passages_embeddings)
-        input_paths = sorted(input_paths)
+        input_paths = src.embeddings.glob_embedding_files(passages_embeddings)
         embeddings_dir = os.path.dirname(input_paths[0])
         index_path = os.path.join(embeddings_dir, "index.faiss")
         if save_or_load_index and os.path.exists(index_path):
@@ -221,6 +501,56 @@ class Retriever:
         self.passage_id_map = {x["id"]: x for x in self.passages}
         print("passages have been loaded")
 
+def gather_search_results(results, n_docs):
+    """Merge the per-rank `SearchResults` of a distributed search into the global top `n_docs`.
+
+    Passage ids are exchanged as int64 so they can be gathered with `varsize_gather_nograd`;
+    every rank receives the merged results.
+    """
+    try:
+        labels = np.where(results.valid, results.ids, "-1").astype("int64")
+    except ValueError:
+        raise ValueError("distributed retrieval requires integer passage ids")
+    scores = np.where(results.valid, results.scores, -np.inf).astype("float32")
+    device = "cuda" if torch.distributed.get_backend() == "nccl" else "cpu"
+    labels = src.dist_utils.varsize_gather_nograd(torch.from_numpy(labels).to(device)).cpu().numpy()
+    scores = src.dist_utils.varsize_gather_nograd(torch.from_numpy(scores).to(device)).cpu().numpy()
+
+    # (world_size * n_queries, k) -> (n_queries, world_size * k)
+    n_queries = len(results)
+    labels = labels.reshape(-1, n_queries, n_docs).transpose(1, 0, 2).reshape(n_queries, -1)
+    scores = scores.reshape(-1, n_queries, n_docs).transpose(1, 0, 2).reshape(n_queries, -1)
+    top = np.argsort(-scores, axis=1, kind="stable")[:, :n_docs]
+    labels, scores = np.take_along_axis(labels, top, axis=1), np.take_along_axis(scores, top, axis=1)
+    ids = labels.astype(str)
+    ids[labels < 0] = ""
+    return src.index.SearchResults(ids, scores, labels)
+
+
+def mmr_select(relevance, vectors, k, lambda_):
+    """Return the positions of `k` of the `vectors`, chosen greedily by maximal marginal relevance.
+
+    Each step takes the vector maximizing `lambda_ * rel(v) - (1 - lambda_) * max cos(v, chosen)`.
+    `relevance` holds the search scores, which Contriever computes as raw inner products; they are
+    divided by the largest absolute score to be on the scale of the cosine redundancy, which keeps
+    their order, so `lambda_ = 1` returns the search order.
+    """
+    relevance = np.asarray(relevance, dtype="float32")
+    relevance = relevance / max(float(np.abs(relevance).max(initial=0)), 1e-12)
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    similarity = vectors @ vectors.T
+    selected = []
+    redundancy = np.zeros(len(vectors), dtype="float32")
+    available = np.ones(len(vectors), dtype=bool)
+    for _ in range(min(k, len(vectors))):
+        gain = np.where(available, lambda_ * relevance - (1 - lambda_) * redundancy, -np.inf)
+        best = int(np.argmax(gain))
+        selected.append(best)
+        available[best] = False
+        redundancy = np.maximum(redundancy, similarity[best])
+    return np.array(selected, dtype="int64")
+
+
 def add_hasanswer(data, hasanswer):
     # add hasanswer to data
     for i, ex in enumerate(data):
@@ -241,15 +571,30 @@ def load_data(data_path):
     return data
 
 
+QUERY_FIELDS = ["question", "virtual_answer"]
+
+
+def load_queries(query, query_field="question"):
+    """Return the questions of a .json file, or their virtual answers written by question_analysis.py."""
+    if '.json' in query:
+        all_QA = json.load(open(query))
+        if query_field == "virtual_answer":
+            return [qa['analysis']['virtual_answer'] for qa in all_QA]
+        return [qa['question'] for qa in all_QA]
+    return [query]
+
+
 def main(args):
     # for debugging
     # data_paths = glob.glob(args.data)
     retriever = Retriever(args)
     retriever.setup_retriever()
+    if args.int8 and args.int8_min_overlap > 0:
+        retriever.check_int8_overlap(load_queries(args.query, args.query_field)[:args.int8_check_queries])
     print(retriever.search_document(args.query, args.n_docs))
 
 
-if __name__ == "__main__":
+def get_parser():
     parser = argparse.ArgumentParser()
 
     parser.add_argument(
@@ -258,8 +603,25 @@ if __name__ == "__main__":
         default=None,
         help=".json file containing question and answers, similar format to reader data",
     )
+    parser.add_argument(
+        "--query_field",
+        type=str,
+        default="question",
+        choices=QUERY_FIELDS,
+        help="Retrieve with the questions of --query or with the virtual answers written by question_analysis.py",
+    )
     parser.add_argument("--passages", type=str, default=None, help="Path to passages (.tsv file)")
-    parser.add_argument("--passages_embeddings", type=str, default=None, help="Glob path to encoded passages")
+    parser.add_argument(
+        "--passage_store",
+        action="store_true",
+        help="Read passage text from a memory-mapped store built next to --passages instead of loading all passages",
+    )
+    parser.add_argument(
+        "--passages_embeddings",
+        type=str,
+        default=None,
+        help="Glob path to encoded passages or to the .json manifest written by generate_passage_embeddings.py",
+    )
     parser.add_argument(
         "--output_dir", type=str, default=None, help="Results are written to outputdir with data suffix"
     )
@@ -271,11 +633,61 @@ if __name__ == "__main__":
     parser.add_argument(
         "--save_or_load_index", action="store_true", help="If enabled, save index and load index if it exists"
     )
+    parser.add_argument(
+        "--mmap_index", action="store_true", help="Memory-map a saved index and its id map instead of reading them into RAM"
+    )
     parser.add_argument(
         "--model_name_or_path", type=str, help="path to directory containing model weights and config file"
     )
     parser.add_argument("--no_fp16", action="store_true", help="inference in fp32")
+    parser.add_argument(
+        "--device", type=str, default=None, help="Device used for encoding, defaults to cuda if available else cpu"
+    )
+    parser.add_argument(
+        "--int8", action="store_true", help="Encode questions on cpu with int8 dynamic quantization"
+    )
+    parser.add_argument(
+        "--int8_min_overlap",
+        type=float,
+        default=0.0,
+        help="With --int8, fail unless the mean top-k overlap with the fp32 model reaches this value; 0 skips the check",
+    )
+    parser.add_argument(
+        "--int8_check_queries", type=int, default=100, help="Number of queries used for the int8 overlap check"
+    )
+    parser.add_argument(
+        "--bucket_by_length",
+        action="store_true",
+        help="Batch questions of similar token length together to reduce padding",
+    )
+    parser.add_argument(
+        "--max_tokens_per_batch",
+        type=int,
+        default=0,
+        help="Token budget of a padded batch, batches hold at most per_gpu_batch_size questions; 0 disables",
+    )
     parser.add_argument("--question_maxlength", type=int, default=512, help="Maximum number of tokens in a question")
+    parser.add_argument(
+        "--query_cache", type=str, default=None, help="SQLite file caching question embeddings across runs"
+    )
+    parser.add_argument(
+        "--query_cache_size_mb",
+        type=float,
+        default=1024,
+        help="Size cap of --query_cache, least recently used embeddings are evicted beyond it",
+    )
+    parser.add_argument(
+        "--result_cache",
+        type=str,
+        default=None,
+        help="SQLite file caching search results across runs, invalidated when the index or embeddings change",
+    )
+    parser.add_argument(
+        "--result_cache_size_mb",
+        type=float,
+        default=1024,
+        help="Size cap of --result_cache, least recently used results are evicted beyond it",
+    )
     parser.add_argument(
         "--indexing_batch_size", type=int, default=1000000, help="Batch size of the number of passages indexed"
     )
@@ -287,12 +699,114 @@ if __name__ == "__main__":
         help="Number of subquantizer used for vector quantization, if 0 flat index is used",
     )
     parser.add_argument("--n_bits", type=int, default=8, help="Number of bits per subquantizer")
+    parser.add_argument(
+        "--index_type",
+        type=str,
+        default=None,
+        choices=src.index.INDEX_TYPES,
+        help="Type of faiss index to build, defaults to pq if n_subquantizers > 0 and flat otherwise",
+    )
+    parser.add_argument("--n_list", type=int, default=4096, help="Number of inverted lists for ivf indexes")
+    parser.add_argument("--hnsw_m", type=int, default=32, help="Number of neighbors per node for hnsw index")
+    parser.add_argument("--ef_construction", type=int, default=200, help="Construction-time search depth for hnsw")
+    parser.add_argument(
+        "--n_train", type=int, default=262144, help="Number of randomly sampled vectors used to train the index"
+    )
+    parser.add_argument(
+        "--explicit_ids",
+        action="store_true",
+        help="Index passages under their integer ids so the saved index can be updated with update_index.py",
+    )
+    parser.add_argument(
+        "--refine_k_factor",
+        type=int,
+        default=0,
+        help="Rescore the top n_docs * refine_k_factor hits of a quantized index with the exact vectors, read from "
+        "the memory-mapped .npy embedding files so they are not held in RAM; 0 disables",
+    )
+    parser.add_argument("--nprobe", type=int, default=None, help="Number of inverted lists visited per query (ivf)")
+    parser.add_argument("--ef_search", type=int, default=None, help="Query-time search depth (hnsw)")
+    parser.add_argument(
+        "--cascade_papers",
+        type=int,
+        default=0,
+        help="Pick this many papers by their paper vectors, then search only their chunks exactly; 0 searches all chunks",
+    )
+    parser.add_argument(
+        "--paper_embeddings",
+        type=str,
+        default=None,
+        help="With --cascade_papers, glob or manifest of paper-level embeddings such as the abstracts; "
+        "defaults to the mean chunk embedding of each paper",
+    )
+    parser.add_argument(
+        "--paper_passages", type=str, default=None, help="Passages (.tsv file) of --paper_embeddings, titles are pids"
+    )
+    parser.add_argument(
+        "--distinct_papers",
+        action="store_true",
+        help="Return the chunks of the top n_docs distinct papers instead of the top n_docs chunks",
+    )
+    parser.add_argument(
+        "--chunks_per_paper", type=int, default=1, help="With --distinct_papers, number of best chunks kept per paper"
+    )
+    parser.add_argument(
+        "--paper_overfetch",
+        type=int,
+        default=4,
+        help="With --distinct_papers, chunks first fetched per requested chunk; doubled until enough papers are found",
+    )
+    parser.add_argument(
+        "--mmr_candidates",
+        type=int,
+        default=0,
+        help="Pick the n_docs hits from this many candidates by maximal marginal relevance; 0 disables",
+    )
+    parser.add_argument(
+        "--mmr_lambda",
+        type=float,
+        default=0.5,
+        help="Weight of relevance against redundancy with --mmr_candidates, 1 keeps the relevance order",
+    )
+    parser.add_argument(
+        "--mmr_vectors",
+        type=str,
+        default="index",
+        choices=["index", "embeddings"],
+        help="Reconstruct candidate vectors from the index, or read the exact ones from the embedding files",
+    )
+    parser.add_argument(
+        "--filter_pids", type=str, default=None, help="Only retrieve chunks of the papers listed in this file, one pid per line"
+    )
+    parser.add_argument("--min_year", type=int, default=None, help="Only retrieve chunks of papers published since this year")
+    parser.add_argument("--max_year", type=int, default=None, help="Only retrieve chunks of papers published until this year")
+    parser.add_argument(
+        "--paper_metadata",
+        type=str,
+        default=None,
+        help="Paper records (.json list or .jsonl) with a pid or pmid and a year, required by --min_year/--max_year",
+    )
+    parser.add_argument(
+        "--local_rank", type=int, default=int(os.environ.get("LOCAL_RANK", -1)), help="For distributed training: local_rank"
+    )
+    parser.add_argument("--main_port", type=int, default=-1, help="Main port (for multi-node SLURM jobs)")
+    parser.add_argument(
+        "--dist_backend",
+        type=str,
+        default=None,
+        choices=["nccl", "gloo"],
+        help="torch.distributed backend, defaults to nccl with cuda and gloo otherwise",
+    )
     parser.add_argument("--lang", nargs="+")
     parser.add_argument("--dataset", type=str, default="none")
     parser.add_argument("--lowercase", action="store_true", help="lowercase text before encoding")
     parser.add_argument("--normalize_text", action="store_true", help="normalize text")
 
-    args = parser.parse_args()
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
     src.slurm.init_distributed_mode(args)
     main(args)
 
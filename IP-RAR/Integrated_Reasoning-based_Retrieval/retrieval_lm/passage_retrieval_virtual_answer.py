@@ -4,575 +4,16 @@
 # # This source code is licensed under the license found in the
 # # LICENSE file in the root directory of this source tree.
 
-import os
-import argparse
-import json
-import pickle
-import time
-import glob
-from pathlib import Path
+# Retrieval with the virtual answers written by question_analysis.py,
+# equivalent to `passage_retrieval.py --query_field virtual_answer`.
 
-import numpy as np
-import torch
-import transformers
-
-import src.index
-import src.contriever
-import src.utils
 import src.slurm
-import src.data
-import src.normalize_text
-
-os.environ["TOKENIZERS_PARALLELISM"] = "true"
-
-
-class Retriever:
-    def __init__(self, args, model=None, tokenizer=None) :
-        self.args = args
-        self.model = model
-        self.tokenizer = tokenizer
-
-    def embed_queries(self, args, queries):
-        embeddings, batch_question = [], []
-        with torch.no_grad():
-            for k, q in enumerate(queries):
-                if args.lowercase:
-                    q = q.lower()
-                if args.normalize_text:
-                    q = src.normalize_text.normalize(q)
-                batch_question.append(q)
-
-                if len(batch_question) == args.per_gpu_batch_size or k == len(queries) - 1:
-
-                    encoded_batch = self.tokenizer.batch_encode_plus(
-                        batch_question,
-                        return_tensors="pt",
-                        max_length=args.question_maxlength,
-                        padding=True,
-                        truncation=True,
-                    )
-                    encoded_batch = {k: v.cuda() for k, v in encoded_batch.items()}
-                    output = self.model(**encoded_batch)
-                    embeddings.append(output.cpu())
-
-                    batch_question = []
-
-        embeddings = torch.cat(embeddings, dim=0)
-        print(f"Questions embeddings shape: {embeddings.size()}")
-
-        return embeddings.numpy()
-    
-
-    def embed_queries_demo(self, queries):
-        embeddings, batch_question = [], []
-        with torch.no_grad():
-            for k, q in enumerate(queries):
-                batch_question.append(q)
-
-                if len(batch_question) == 16 or k == len(queries) - 1:
-
-                    encoded_batch = self.tokenizer.batch_encode_plus(
-                        batch_question,
-                        return_tensors="pt",
-                        max_length=200,
-                        padding=True,
-                        truncation=True,
-                    )
-                    encoded_batch = {k: v.cuda() for k, v in encoded_batch.items()}
-                    output = self.model(**encoded_batch)
-                    embeddings.append(output.cpu())
-
-                    batch_question = []
-
-        embeddings = torch.cat(embeddings, dim=0)
-        print(f"Questions embeddings shape: {embeddings.size()}")
-
-        return embeddings.numpy()
-
-    def index_encoded_data(self, index, embedding_files, indexing_batch_size):
-        allids = []
-        allembeddings = np.array([])
-        for i, file_path in enumerate(embedding_files):
-            print(f"Loading file {file_path}")
-            with open(file_path, "rb") as fin:
-                ids, embeddings = pickle.load(fin)
-
-            allembeddings = np.vstack((allembeddings, embeddings)) if allembeddings.size else embeddings
-            allids.extend(ids)
-            while allembeddings.shape[0] > indexing_batch_size:
-                allembeddings, allids = self.add_embeddings(index, allembeddings, allids, indexing_batch_size)
-
-        while allembeddings.shape[0] > 0:
-            allembeddings, allids = self.add_embeddings(index, allembeddings, allids, indexing_batch_size)
-
-        print("Data indexing completed.")
-
-
-    def add_embeddings(self, index, embeddings, ids, indexing_batch_size):
-        end_idx = min(indexing_batch_size, embeddings.shape[0])
-        ids_toadd = ids[:end_idx]
-        embeddings_toadd = embeddings[:end_idx]
-        ids = ids[end_idx:]
-        embeddings = embeddings[end_idx:]
-        index.index_data(ids_toadd, embeddings_toadd)
-        return embeddings, ids
-
-
-    def add_passages(self, passages, top_passages_and_scores):
-        # add passages to original data
-        docs = [passages[doc_id] for doc_id in top_passages_and_scores[0][0]]
-        return docs
-
-    def setup_retriever(self):
-        print(f"Loading model from: {self.args.model_name_or_path}")
-        self.model, self.tokenizer, _ = src.contriever.load_retriever(self.args.model_name_or_path)
-        self.model.eval()
-        self.model = self.model.cuda()
-        if not self.args.no_fp16:
-            self.model = self.model.half()
-
-        self.index = src.index.Indexer(self.args.projection_size, self.args.n_subquantizers, self.args.n_bits)
-
-        # index all passages
-        input_paths = glob.glob(self.args.passages_embeddings)
-        input_paths = sorted(input_paths)
-        embeddings_dir = os.path.dirname(input_paths[0])
-        index_path = os.path.join(embeddings_dir, "index.faiss")
-        if self.args.save_or_load_index and os.path.exists(index_path):
-            self.index.deserialize_from(embeddings_dir)
-        else:
-            print(f"Indexing passages from files {input_paths}")
-            start_time_indexing = time.time()
-            self.index_encoded_data(self.index, input_paths, self.args.indexing_batch_size)
-            print(f"Indexing time: {time.time()-start_time_indexing:.1f} s.")
-            if self.args.save_or_load_index:
-                self.index.serialize(embeddings_dir)
-
-        # load passages
-        print("loading passages")
-        self.passages = src.data.load_passages(self.args.passages)
-        self.passage_id_map = {x["id"]: x for x in self.passages}
-        print("passages have been loaded")
-
-    def search_document(self, query, top_n=10):
-        if '.json' in query:
-            all_QA = json.load(open(query))
-            queries = [qa['analysis']['virtual_answer'] for qa in all_QA]
-            questions_embedding = self.embed_queries(self.args, queries)
-        else:
-            questions_embedding = self.embed_queries(self.args, [query])
-
-        # get top k results
-        start_time_retrieval = time.time()
-        top_ids_and_scores = self.index.search_knn(questions_embedding, self.args.n_docs)
-        print(f"Search time: {time.time()-start_time_retrieval:.1f} s.")
-
-        # save into output_dir
-        retrieved_results = []
-        # "question", "answer", "ctxs"
-        for q_i, (question, top_id_score) in enumerate(zip(queries, top_ids_and_scores)):
-            result = {
-                "question": question,
-            }
-            result['ctxs'] = [{'id': top_id_score[0][s_i], 'text': self.passage_id_map[top_id_score[0][s_i]]['text'], 'score': str(top_id_score[1][s_i])} for s_i in range(len(top_id_score[0]))]
-            retrieved_results.append(result)
-
-        with open(args.output_dir+'.jsonl', 'w') as jsonl_file:
-            for item in retrieved_results:
-                jsonl_file.write(json.dumps(item) + '\n')
-            
-
-        return self.add_passages(self.passage_id_map, top_ids_and_scores)[:top_n]
-    
-    def search_document_demo(self, query, n_docs=10):
-        questions_embedding = self.embed_queries_demo([query])
-
-        # get top k results
-        start_time_retrieval = time.time()
-        top_ids_and_scores = self.index.search_knn(questions_embedding, n_docs)
-        print(f"Search time: {time.time()-start_time_retrieval:.1f} s.")
-
-        return self.add_passages(self.passage_id_map, top_ids_and_scores)[:n_docs]
-
-    def setup_retriever_demo(self, model_name_or_path, passages, passages_embeddings, n_docs=5, save_or_load_index=False):
-        print(f"Loading model from: {model_name_or_path}")
-        self.model, self.tokenizer, _ = src.contriever.load_retriever(model_name_or_path)
-        self.model.eval()
-        self.model = self.model.cuda()
-
-        self.index = src.index.Indexer(768, 0, 8)
-
-        # index all passages
-        input_paths = glob.glob(passages_embeddings)
-        input_paths = sorted(input_paths)
-        embeddings_dir = os.path.dirname(input_paths[0])
-        index_path = os.path.join(embeddings_dir, "index.faiss")
-        if save_or_load_index and os.path.exists(index_path):
-            self.index.deserialize_from(embeddings_dir)
-        else:
-            print(f"Indexing passages from files {input_paths}")
-            start_time_indexing = time.time()
-            self.index_encoded_data(self.index, input_paths, 1000000)
-            print(f"Indexing time: {time.time()-start_time_indexing:.1f} s.")
-
-        # load passages
-        print("loading passages")
-        self.passages = src.data.load_passages(passages)
-        self.passage_id_map = {x["id"]: x for x in self.passages}
-        print("passages have been loaded")
-
-def add_hasanswer(data, hasanswer):
-    # add hasanswer to data
-    for i, ex in enumerate(data):
-        for k, d in enumerate(ex["ctxs"]):
-            d["hasanswer"] = hasanswer[i][k]
-
-
-def load_data(data_path):
-    if data_path.endswith(".json"):
-        with open(data_path, "r") as fin:
-            data = json.load(fin)
-    elif data_path.endswith(".jsonl"):
-        data = []
-        with open(data_path, "r") as fin:
-            for k, example in enumerate(fin):
-                example = json.loads(example)
-                data.append(example)
-    return data
-
-
-def main(args):
-    # for debugging
-    # data_paths = glob.glob(args.data)
-    retriever = Retriever(args)
-    retriever.setup_retriever()
-    print(retriever.search_document(args.query, args.n_docs))
+from passage_retrieval import get_parser, main
 
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-
-    parser.add_argument(
-        "--query",
-        type=str,
-        default=None,
-        help=".json file containing question and answers, similar format to reader data",
-    )
-    parser.add_argument("--passages", type=str, default=None, help="Path to passages (.tsv file)")
-    parser.add_argument("--passages_embeddings", type=str, default=None, help="Glob path to encoded passages")
-    parser.add_argument(
-        "--output_dir", type=str, default=None, help="Results are written to outputdir with data suffix"
-    )
-    parser.add_argument("--n_docs", type=int, default=100, help="Number of documents to retrieve per questions")
-    parser.add_argument(
-        "--validation_workers", type=int, default=32, help="Number of parallel processes to validate results"
-    )
-    parser.add_argument("--per_gpu_batch_size", type=int, default=64, help="Batch size for question encoding")
-    parser.add_argument(
-        "--save_or_load_index", action="store_true", help="If enabled, save index and load index if it exists"
-    )
-    parser.add_argument(
-        "--model_name_or_path", type=str, help="path to directory containing model weights and config file"
-    )
-    parser.add_argument("--no_fp16", action="store_true", help="inference in fp32")
-    parser.add_argument("--question_maxlength", type=int, default=512, help="Maximum number of tokens in a question")
-    parser.add_argument(
-        "--indexing_batch_size", type=int, default=1000000, help="Batch size of the number of passages indexed"
-    )
-    parser.add_argument("--projection_size", type=int, default=768)
-    parser.add_argument(
-        "--n_subquantizers",
-        type=int,
-        default=0,
-        help="Number of subquantizer used for vector quantization, if 0 flat index is used",
-    )
-    parser.add_argument("--n_bits", type=int, default=8, help="Number of bits per subquantizer")
-    parser.add_argument("--lang", nargs="+")
-    parser.add_argument("--dataset", type=str, default="none")
-    parser.add_argument("--lowercase", action="store_true", help="lowercase text before encoding")
-    parser.add_argument("--normalize_text", action="store_true", help="normalize text")
-
+    parser = get_parser()
+    parser.set_defaults(query_field="virtual_answer")
     args = parser.parse_args()
     src.slurm.init_distributed_mode(args)
     main(args)
-
-
-# import os
-# import argparse
-# import json
-# import pickle
-# import time
-# import glob
-# from pathlib import Path
-
-# import numpy as np
-# import torch
-# import transformers
-
-# import src.index
-# import src.contriever
-# import src.utils
-# import src.slurm
-# import src.data
-# from src.evaluation import calculate_matches
-# import src.normalize_text
-
-# os.environ["TOKENIZERS_PARALLELISM"] = "true"
-
-
-# class Retriever:
-#     def __init__(self, args, model=None, tokenizer=None) :
-#         self.args = args
-#         self.model = model
-#         self.tokenizer = tokenizer
-
-#     def embed_queries(self, args, queries):
-#         embeddings, batch_question = [], []
-#         with torch.no_grad():
-#             for k, q in enumerate(queries):
-#                 if args.lowercase:
-#                     q = q.lower()
-#                 if args.normalize_text:
-#                     q = src.normalize_text.normalize(q)
-#                 batch_question.append(q)
-
-#                 if len(batch_question) == args.per_gpu_batch_size or k == len(queries) - 1:
-
-#                     encoded_batch = self.tokenizer.batch_encode_plus(
-#                         batch_question,
-#                         return_tensors="pt",
-#                         max_length=args.question_maxlength,
-#                         padding=True,
-#                         truncation=True,
-#                     )
-#                     encoded_batch = {k: v.cuda() for k, v in encoded_batch.items()}
-#                     output = self.model(**encoded_batch)
-#                     embeddings.append(output.cpu())
-
-#                     batch_question = []
-
-#         embeddings = torch.cat(embeddings, dim=0)
-#         print(f"Questions embeddings shape: {embeddings.size()}")
-
-#         return embeddings.numpy()
-    
-
-#     def embed_queries_demo(self, queries):
-#         embeddings, batch_question = [], []
-#         with torch.no_grad():
-#             for k, q in enumerate(queries):
-#                 batch_question.append(q)
-
-#                 if len(batch_question) == 16 or k == len(queries) - 1:
-
-#                     encoded_batch = self.tokenizer.batch_encode_plus(
-#                         batch_question,
-#                         return_tensors="pt",
-#                         max_length=200,
-#                         padding=True,
-#                         truncation=True,
-#                     )
-#                     encoded_batch = {k: v.cuda() for k, v in encoded_batch.items()}
-#                     output = self.model(**encoded_batch)
-#                     embeddings.append(output.cpu())
-
-#                     batch_question = []
-
-#         embeddings = torch.cat(embeddings, dim=0)
-#         print(f"Questions embeddings shape: {embeddings.size()}")
-
-#         return embeddings.numpy()
-
-#     def index_encoded_data(self, index, embedding_files, indexing_batch_size):
-#         allids = []
-#         allembeddings = np.array([])
-#         for i, file_path in enumerate(embedding_files):
-#             print(f"Loading file {file_path}")
-#             with open(file_path, "rb") as fin:
-#                 ids, embeddings = pickle.load(fin)
-
-#             allembeddings = np.vstack((allembeddings, embeddings)) if allembeddings.size else embeddings
-#             allids.extend(ids)
-#             while allembeddings.shape[0] > indexing_batch_size:
-#                 allembeddings, allids = self.add_embeddings(index, allembeddings, allids, indexing_batch_size)
-
-#         while allembeddings.shape[0] > 0:
-#             allembeddings, allids = self.add_embeddings(index, allembeddings, allids, indexing_batch_size)
-
-#         print("Data indexing completed.")
-
-
-#     def add_embeddings(self, index, embeddings, ids, indexing_batch_size):
-#         end_idx = min(indexing_batch_size, embeddings.shape[0])
-#         ids_toadd = ids[:end_idx]
-#         embeddings_toadd = embeddings[:end_idx]
-#         ids = ids[end_idx:]
-#         embeddings = embeddings[end_idx:]
-#         index.index_data(ids_toadd, embeddings_toadd)
-#         return embeddings, ids
-
-
-#     def add_passages(self, passages, top_passages_and_scores):
-#         # add passages to original data
-#         docs = [passages[doc_id] for doc_id in top_passages_and_scores[0][0]]
-#         return docs
-
-#     def setup_retriever(self):
-#         print(f"Loading model from: {self.args.model_name_or_path}")
-#         self.model, self.tokenizer, _ = src.contriever.load_retriever(self.args.model_name_or_path)
-#         self.model.eval()
-#         self.model = self.model.cuda()
-#         if not self.args.no_fp16:
-#             self.model = self.model.half()
-
-#         self.index = src.index.Indexer(self.args.projection_size, self.args.n_subquantizers, self.args.n_bits)
-
-#         # index all passages
-#         input_paths = glob.glob(self.args.passages_embeddings)
-#         input_paths = sorted(input_paths)
-#         embeddings_dir = os.path.dirname(input_paths[0])
-#         index_path = os.path.join(embeddings_dir, "index.faiss")
-#         if self.args.save_or_load_index and os.path.exists(index_path):
-#             self.index.deserialize_from(embeddings_dir)
-#         else:
-#             print(f"Indexing passages from files {input_paths}")
-#             start_time_indexing = time.time()
-#             self.index_encoded_data(self.index, input_paths, self.args.indexing_batch_size)
-#             print(f"Indexing time: {time.time()-start_time_indexing:.1f} s.")
-#             if self.args.save_or_load_index:
-#                 self.index.serialize(embeddings_dir)
-
-#         # load passages
-#         print("loading passages")
-#         self.passages = src.data.load_passages(self.args.passages)
-#         self.passage_id_map = {x["id"]: x for x in self.passages}
-#         print("passages have been loaded")
-
-#     def search_document(self, query, top_n=10):
-#         questions_embedding = self.embed_queries(self.args, [query])
-
-#         # get top k results
-#         start_time_retrieval = time.time()
-#         top_ids_and_scores = self.index.search_knn(questions_embedding, self.args.n_docs)
-#         print(f"Search time: {time.time()-start_time_retrieval:.1f} s.")
-
-#         return self.add_passages(self.passage_id_map, top_ids_and_scores)[:top_n]
-    
-#     def search_document_demo(self, query, n_docs=10):
-#         questions_embedding = self.embed_queries_demo([query])
-
-#         # get top k results
-#         start_time_retrieval = time.time()
-#         top_ids_and_scores = self.index.search_knn(questions_embedding, n_docs)
-#         print(f"Search time: {time.time()-start_time_retrieval:.1f} s.")
-
-#         return self.add_passages(self.passage_id_map, top_ids_and_scores)[:n_docs]
-
-#     def setup_retriever_demo(self, model_name_or_path, passages, passages_embeddings, n_docs=5, save_or_load_index=False):
-#         print(f"Loading model from: {model_name_or_path}")
-#         self.model, self.tokenizer, _ = src.contriever.load_retriever(model_name_or_path)
-#         self.model.eval()
-#         self.model = self.model.cuda()
-
-#         self.index = src.index.Indexer(768, 0, 8)
-
-#         # index all passages
-#         input_paths = glob.glob(passages_embeddings)
-#         input_paths = sorted(input_paths)
-#         embeddings_dir = os.path.dirname(input_paths[0])
-#         index_path = os.path.join(embeddings_dir, "index.faiss")
-#         if save_or_load_index and os.path.exists(index_path):
-#             self.index.deserialize_from(embeddings_dir)
-#         else:
-#             print(f"Indexing passages from files {input_paths}")
-#             start_time_indexing = time.time()
-#             self.index_encoded_data(self.index, input_paths, 1000000)
-#             print(f"Indexing time: {time.time()-start_time_indexing:.1f} s.")
-
-#         # load passages
-#         print("loading passages")
-#         self.passages = src.data.load_passages(passages)
-#         self.passage_id_map = {x["id"]: x for x in self.passages}
-#         print("passages have been loaded")
-
-# def add_hasanswer(data, hasanswer):
-#     # add hasanswer to data
-#     for i, ex in enumerate(data):
-#         for k, d in enumerate(ex["ctxs"]):
-#             d["hasanswer"] = hasanswer[i][k]
-
-
-# def load_data(data_path):
-#     if data_path.endswith(".json"):
-#         with open(data_path, "r") as fin:
-#             data = json.load(fin)
-#     elif data_path.endswith(".jsonl"):
-#         data = []
-#         with open(data_path, "r") as fin:
-#             for k, example in enumerate(fin):
-#                 example = json.loads(example)
-#                 data.append(example)
-#     return data
-
-# def load_passages(file_path):
-#     passages = []
-#     with open(file_path, 'r', encoding='utf-8') as file:
-#         for line in file:
-#             passage = json.loads(line)
-#             passages.append(passage)
-#     return passages
-
-# def main(args):
-#     # for debugging
-#     # data_paths = glob.glob(args.data)
-#     retriever = Retriever(args)
-#     retriever.setup_retriever()
-#     print(retriever.search_document(args.query, args.n_docs))
-
-
-# if __name__ == "__main__":
-#     parser = argparse.ArgumentParser()
-
-#     parser.add_argument(
-#         "--query",
-#         type=str,
-#         default=None,
-#         help=".json file containing question and answers, similar format to reader data",
-#     )
-#     parser.add_argument("--passages", type=str, default=None, help="Path to passages (.jsonl file)")
-#     parser.add_argument("--passages_embeddings", type=str, default=None, help="Glob path to encoded passages")
-#     parser.add_argument(
-#         "--output_dir", type=str, default=None, help="Results are written to outputdir with data suffix"
-#     )
-#     parser.add_argument("--n_docs", type=int, default=100, help="Number of documents to retrieve per questions")
-#     parser.add_argument(
-#         "--validation_workers", type=int, default=32, help="Number of parallel processes to validate results"
-#     )
-#     parser.add_argument("--per_gpu_batch_size", type=int, default=64, help="Batch size for question encoding")
-#     parser.add_argument(
-#         "--save_or_load_index", action="store_true", help="If enabled, save index and load index if it exists"
-#     )
-#     parser.add_argument(
-#         "--model_name_or_path", type=str, help="path to directory containing model weights and config file"
-#     )
-#     parser.add_argument("--no_fp16", action="store_true", help="inference in fp32")
-#     parser.add_argument("--question_maxlength", type=int, default=512, help="Maximum number of tokens in a question")
-#     parser.add_argument(
-#         "--indexing_batch_size", type=int, default=1000000, help="Batch size of the number of passages indexed"
-#     )
-#     parser.add_argument("--projection_size", type=int, default=768)
-#     parser.add_argument(
-#         "--n_subquantizers",
-#         type=int,
-#         default=0,
-#         help="Number of subquantizer used for vector quantization, if 0 flat index is used",
-#     )
-#     parser.add_argument("--n_bits", type=int, default=8, help="Number of bits per subquantizer")
-#     parser.add_argument("--lang", nargs="+")
-#     parser.add_argument("--dataset", type=str, default="none")
-#     parser.add_argument("--lowercase", action="store_true", help="lowercase text before encoding")
-#     parser.add_argument("--normalize_text", action="store_true", help="normalize text")
-
-#     args = parser.parse_args()
-#     src.slurm.init_distributed_mode(args)
-#     main(args)
\ No newline at end of file
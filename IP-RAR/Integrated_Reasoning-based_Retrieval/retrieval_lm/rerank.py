@@ -0,0 +1,114 @@
+# Rerank the chunks selected by Aggregator.py with a cross-encoder before Generation.py, so that
+# only the top chunks of every question reach the LLM.
+
+import json
+import time
+import argparse
+
+import numpy as np
+import torch
+import transformers
+
+import src.contriever
+import src.encoding
+
+
+@torch.no_grad()
+def score_pairs(model, tokenizer, questions, texts, args):
+    """Cross-encoder relevance scores of (question, text) pairs, batched by token length."""
+    batches = src.encoding.make_batches(
+        tokenizer,
+        questions,
+        args.max_length,
+        args.batch_size,
+        max_tokens=args.max_tokens_per_batch,
+        sort_by_length=True,
+        text_pairs=texts,
+    )
+    device = next(model.parameters()).device
+    scores = np.empty(len(questions), dtype="float32")
+    for positions, encoded_batch in batches:
+        encoded_batch = {k: v.to(device) for k, v in encoded_batch.items()}
+        # a single relevance logit, or the positive class of a two-class head
+        scores[positions] = model(**encoded_batch).logits[:, -1].float().cpu().numpy()
+    return scores
+
+
+def rerank(aggregated, questions, model, tokenizer, args):
+    """Keep the `top_k` of the `top_n_candidates` best aggregated chunks of every question, by cross-encoder score."""
+    candidates = []
+    for q_i, (item, question) in enumerate(zip(aggregated, questions)):
+        texts = sorted(
+            [(entry["pid"], text) for entry in item for text in entry["texts"]], key=lambda x: x[1]["score"], reverse=True
+        )
+        candidates.extend((q_i, question, pid, text) for pid, text in texts[:args.top_n_candidates])
+
+    start_time = time.time()
+    scores = score_pairs(model, tokenizer, [c[1] for c in candidates], [c[3]["text"] for c in candidates], args)
+    print(f"Scored {len(candidates)} chunks of {len(aggregated)} questions in {time.time()-start_time:.1f} s.")
+
+    reranked = [[] for _ in aggregated]
+    for candidate, score in zip(candidates, scores):
+        reranked[candidate[0]].append((float(score), candidate))
+    results = []
+    for item in reranked:
+        # same layout as the Aggregator output, with the cross-encoder score as the text score
+        by_pid = {}
+        for score, (_, _, pid, text) in sorted(item, key=lambda x: x[0], reverse=True)[:args.top_k]:
+            by_pid.setdefault(pid, []).append(dict(text, score=score, aggregator_score=text["score"]))
+        results.append([{"pid": pid, "texts": texts} for pid, texts in by_pid.items()])
+    return results
+
+
+def main(args):
+    with open(args.aggregated) as fin:
+        aggregated = json.load(fin)
+    with open(args.questions) as fin:
+        questions = [qa["question"] for qa in json.load(fin)]
+    if len(questions) != len(aggregated):
+        raise ValueError(f"{args.questions} holds {len(questions)} questions, {args.aggregated} {len(aggregated)} results")
+
+    tokenizer = transformers.AutoTokenizer.from_pretrained(args.model_name_or_path)
+    model = transformers.AutoModelForSequenceClassification.from_pretrained(args.model_name_or_path)
+    model = src.contriever.prepare_for_inference(model, args.device, fp16=not args.no_fp16, int8=args.int8)
+    print(f"Model loaded from {args.model_name_or_path}.", flush=True)
+
+    results = rerank(aggregated, questions, model, tokenizer, args)
+    with open(args.output, "w", encoding="utf-8") as fout:
+        json.dump(results, fout, ensure_ascii=False, indent=4)
+    print(f"Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--aggregated", type=str, required=True, help="Output file of Aggregator.py")
+    parser.add_argument(
+        "--questions", type=str, required=True, help=".json file with the questions, in the order of --aggregated"
+    )
+    parser.add_argument("--output", type=str, required=True, help="Reranked results, in the format of --aggregated")
+    parser.add_argument(
+        "--model_name_or_path", type=str, default="ncbi/MedCPT-Cross-Encoder", help="Cross-encoder used for scoring"
+    )
+    parser.add_argument(
+        "--top_n_candidates", type=int, default=50, help="Number of best aggregated chunks scored per question"
+    )
+    parser.add_argument("--top_k", type=int, default=10, help="Number of chunks kept per question")
+    parser.add_argument("--batch_size", type=int, default=32, help="Maximum number of pairs scored together")
+    parser.add_argument(
+        "--max_tokens_per_batch",
+        type=int,
+        default=8192,
+        help="Token budget of a padded batch of length-sorted pairs, 0 disables",
+    )
+    parser.add_argument("--max_length", type=int, default=512, help="Maximum number of tokens in a pair")
+    parser.add_argument(
+        "--device", type=str, default="cpu", help="Device used for scoring"
+    )
+    parser.add_argument("--no_fp16", action="store_true", help="inference in fp32 on gpu")
+    parser.add_argument(
+        "--int8", action="store_true", help="Score on cpu with int8 dynamic quantization of the linear layers"
+    )
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,225 @@
+# Long-lived retrieval service: the model, index and passages stay loaded, and concurrent
+# requests are grouped into micro-batches for query encoding and index search.
+#
+#   curl -s localhost:8000/search -d '{"query": "What is the genetic cause of ...?", "n_docs": 10}'
+
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import src.slurm
+import src.cache
+import src.index
+from passage_retrieval import Retriever, get_parser
+
+
+class MicroBatcher(object):
+    """Runs queries submitted from many threads in batches on one worker thread.
+
+    A batch is closed when it holds `max_batch_size` queries or `max_wait` seconds after its
+    first query arrived, whichever comes first. Queries with results in the retriever's result
+    cache are neither embedded nor searched. With a `semantic_cache`, queries close enough to a
+    recently answered one get its results without a search.
+    """
+
+    def __init__(self, retriever, max_batch_size=32, max_wait=0.005, semantic_cache=None):
+        self.retriever = retriever
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.semantic_cache = semantic_cache
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def search(self, query, n_docs):
+        return self.search_many([query], n_docs)[0]
+
+    def search_many(self, queries, n_docs):
+        # queued together from the calling thread, so they land in the same batches
+        requests = [{"query": query, "n_docs": n_docs, "done": threading.Event()} for query in queries]
+        for request in requests:
+            self.requests.put(request)
+        for request in requests:
+            request["done"].wait()
+        for request in requests:
+            if "error" in request:
+                raise request["error"]
+        return [request["result"] for request in requests]
+
+    def _next_batch(self):
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                pending = self._cached_results(batch)
+                if pending:
+                    self._search(pending)
+            except Exception as e:
+                for request in batch:
+                    request["error"] = e
+            for request in batch:
+                request["done"].set()
+
+    def _cached_results(self, batch):
+        # answer the requests found in the result cache, return the others
+        result_cache = self.retriever.result_cache
+        if result_cache is None:
+            return batch
+        for request in batch:
+            request["key"] = self.retriever.result_keys([request["query"]], request["n_docs"])[0]
+        cached = result_cache.get_many([request["key"] for request in batch])
+        pending = []
+        for request in batch:
+            if request["key"] not in cached:
+                pending.append(request)
+                continue
+            ids, scores, indexes = cached[request["key"]]
+            hits = src.index.SearchResults(ids[None], scores[None], indexes[None])
+            request["result"] = {"ctxs": self.retriever.make_ctxs(hits, 0)}
+        return pending
+
+    def _search(self, batch):
+        args = self.retriever.args
+        embeddings = self.retriever.embed_queries(args, [request["query"] for request in batch])
+        matches = [None] * len(batch)
+        if self.semantic_cache is not None:
+            matches = self.semantic_cache.lookup(
+                embeddings, accept=lambda row, payload: payload["n_docs"] >= batch[row]["n_docs"]
+            )
+        for request, match in zip(batch, matches):
+            if match is not None:
+                cache_id, payload = match
+                request["result"] = dict(payload, ctxs=payload["ctxs"][:request["n_docs"]], cache_id=cache_id)
+                request["result"].pop("n_docs")
+
+        missing = [i for i, match in enumerate(matches) if match is None]
+        if not missing:
+            return
+        top_ids_and_scores = self.retriever.search_knn(embeddings[missing], max(batch[i]["n_docs"] for i in missing))
+        for q_i, i in enumerate(missing):
+            ctxs = self.retriever.make_ctxs(top_ids_and_scores, q_i, batch[i]["n_docs"])
+            batch[i]["result"] = {"ctxs": ctxs}
+            if self.semantic_cache is not None:
+                payload = {"ctxs": ctxs, "n_docs": batch[i]["n_docs"]}
+                batch[i]["result"]["cache_id"] = self.semantic_cache.add(embeddings[i], payload)
+        if self.retriever.result_cache is not None:
+            rows = [
+                (top_ids_and_scores.ids[q_i][:n_docs], top_ids_and_scores.scores[q_i][:n_docs],
+                 top_ids_and_scores.indexes[q_i][:n_docs])
+                for q_i, n_docs in enumerate(batch[i]["n_docs"] for i in missing)
+            ]
+            self.retriever.result_cache.put_many([batch[i]["key"] for i in missing], rows)
+
+class RetrievalHandler(BaseHTTPRequestHandler):
+    """POST /search with {"query": ..., "n_docs": ...}, or {"queries": [...]}; GET /health.
+
+    With the semantic cache, search results carry a `cache_id`; POST /generation with
+    {"cache_id": ..., "generation": ...} attaches an answer that is returned with later hits,
+    and GET /metrics reports the hit rate.
+    """
+
+    batcher = None
+    default_n_docs = 10
+
+    def do_GET(self):
+        if self.path == "/health":
+            return self._reply(200, {"status": "ok"})
+        if self.path == "/metrics" and self.batcher.semantic_cache is not None:
+            return self._reply(200, self.batcher.semantic_cache.metrics())
+        self._reply(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path == "/generation" and self.batcher.semantic_cache is not None:
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                stored = self.batcher.semantic_cache.update(int(request["cache_id"]), generation=request["generation"])
+            except (ValueError, KeyError, TypeError) as e:
+                return self._reply(400, {"error": str(e)})
+            return self._reply(200 if stored else 404, {"stored": stored})
+        if self.path != "/search":
+            return self._reply(404, {"error": f"unknown path {self.path}"})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            n_docs = int(request.get("n_docs", self.default_n_docs))
+            if n_docs < 1:
+                raise ValueError(f"n_docs must be at least 1, got {n_docs}")
+            if "queries" in request:
+                # queued by this thread, no thread is started per query
+                results = self.batcher.search_many(request["queries"], n_docs)
+                response = {"results": [dict(result, question=q) for q, result in zip(request["queries"], results)]}
+            else:
+                response = dict(self.batcher.search(request["query"], n_docs), question=request["query"])
+        except (ValueError, KeyError, TypeError) as e:
+            return self._reply(400, {"error": str(e)})
+        except Exception as e:
+            return self._reply(500, {"error": str(e)})
+        self._reply(200, response)
+
+    def _reply(self, status, body):
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main(args):
+    retriever = Retriever(args)
+    retriever.setup_retriever()
+    retriever.verbose = False
+    semantic_cache = None
+    if args.semantic_cache_size > 0:
+        semantic_cache = src.cache.SemanticCache(
+            args.projection_size, args.semantic_cache_size, args.semantic_cache_threshold
+        )
+    RetrievalHandler.batcher = MicroBatcher(retriever, args.max_batch_size, args.max_wait_ms / 1000, semantic_cache)
+    RetrievalHandler.default_n_docs = args.n_docs
+    server = ThreadingHTTPServer((args.host, args.port), RetrievalHandler)
+    print(f"Serving retrieval on http://{args.host}:{args.port}/search", flush=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = get_parser()
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address the server listens on")
+    parser.add_argument("--port", type=int, default=8000, help="Port the server listens on")
+    parser.add_argument("--max_batch_size", type=int, default=32, help="Maximum number of queries encoded together")
+    parser.add_argument(
+        "--max_wait_ms",
+        type=float,
+        default=5.0,
+        help="How long the first query of a batch waits for more queries before the batch is encoded",
+    )
+    parser.add_argument(
+        "--semantic_cache_size",
+        type=int,
+        default=0,
+        help="Number of recent queries whose results are reused for paraphrased queries, 0 disables",
+    )
+    parser.add_argument(
+        "--semantic_cache_threshold",
+        type=float,
+        default=0.95,
+        help="Cosine similarity of the query embeddings above which cached results are returned",
+    )
+    args = parser.parse_args()
+    src.slurm.init_distributed_mode(args)
+    main(args)
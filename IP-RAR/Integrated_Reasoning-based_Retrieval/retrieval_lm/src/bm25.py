@@ -0,0 +1,302 @@
+import os
+import re
+import json
+import shutil
+
+import numpy as np
+
+import src.data
+
+TOKEN_RE = re.compile(r"\w+(?:[-.]\w+)*")
+
+
+def tokenize(text):
+    """Lowercased word tokens; identifiers such as `il-6` or `brca1` are kept as one token."""
+    return TOKEN_RE.findall(text.lower())
+
+
+def varbyte_encode(values):
+    """Encode non-negative integers in 7-bit groups, low group first, the high bit marking the last byte.
+
+    Returns the encoded bytes and the number of bytes of every value.
+    """
+    values = np.asarray(values, dtype="uint64")
+    n_bytes = np.ones(len(values), dtype="int64")
+    for k in range(1, 10):
+        n_bytes += values >= (np.uint64(1) << np.uint64(7 * k))
+    starts = np.cumsum(n_bytes) - n_bytes
+    out = np.empty(int(n_bytes.sum()), dtype="uint8")
+    for k in range(int(n_bytes.max(initial=0))):
+        selected = n_bytes > k
+        group = (values[selected] >> np.uint64(7 * k)) & np.uint64(0x7F)
+        last = n_bytes[selected] == k + 1
+        out[starts[selected] + k] = group.astype("uint8") | (last.astype("uint8") << 7)
+    return out, n_bytes
+
+
+def varbyte_decode(data):
+    data = np.asarray(data, dtype="uint8")
+    is_last = (data & 0x80) > 0
+    value_of_byte = np.concatenate([[0], np.cumsum(is_last)[:-1]])
+    first_byte = np.flatnonzero(np.concatenate([[True], is_last[:-1]]))
+    shift = 7 * (np.arange(len(data)) - first_byte[value_of_byte])
+    # exact in float64 for values below 2**53
+    groups = (data & 0x7F).astype("float64") * np.exp2(shift)
+    return np.bincount(value_of_byte, weights=groups, minlength=int(is_last.sum())).astype("int64")
+
+
+class BM25Index(object):
+    """BM25 inverted index with block-compressed posting lists, queried with MaxScore.
+
+    The postings of a term are sorted by document and cut into blocks of `block_size`. A block
+    stores the document gaps and then the term frequencies, varbyte-encoded, and the last document
+    of every block is kept uncompressed so that blocks can be skipped. Every term also stores the
+    highest score it gives to any document, which lets `search` stop adding new candidate documents
+    once the terms left cannot lift a new document into the top k, and from then on decode only
+    the blocks holding current candidates. Documents are numbered by their line in the passages file.
+    """
+
+    FILES = ("terms", "df", "max_score", "term_blocks", "block_starts", "block_offsets", "block_last",
+             "doc_lengths", "ids")
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, "meta.json")) as fin:
+            self.meta = json.load(fin)
+        for name in self.FILES:
+            setattr(self, name, np.load(os.path.join(index_dir, name + ".npy"), mmap_mode="r"))
+        self.postings = np.memmap(os.path.join(index_dir, "postings.bin"), dtype="uint8", mode="r") \
+            if os.path.getsize(os.path.join(index_dir, "postings.bin")) > 0 else np.empty(0, dtype="uint8")
+        self.k1, self.b = self.meta["k1"], self.meta["b"]
+        self.n_docs, self.avgdl = self.meta["n_docs"], self.meta["avgdl"]
+
+    def __len__(self):
+        return self.n_docs
+
+    def idf(self, df):
+        return np.log(1 + (self.n_docs - df + 0.5) / (df + 0.5))
+
+    def term_scores(self, term, docs, tfs):
+        norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[docs] / self.avgdl)
+        return (self.idf(self.df[term]) * tfs * (self.k1 + 1) / (tfs + norm)).astype("float32")
+
+    def term_ids(self, tokens):
+        """Ids of the tokens found in the vocabulary, with their number of occurrences."""
+        tokens, counts = np.unique(np.asarray(tokens, dtype=str), return_counts=True)
+        pos = np.minimum(np.searchsorted(self.terms, tokens), len(self.terms) - 1)
+        found = self.terms[pos] == tokens if len(self.terms) else np.zeros(len(tokens), dtype=bool)
+        return pos[found], counts[found]
+
+    def decode_blocks(self, blocks):
+        """Return the documents and term frequencies of the given blocks, in block order."""
+        blocks = np.asarray(blocks, dtype="int64")
+        if len(blocks) == 0:
+            return np.empty(0, dtype="int64"), np.empty(0, dtype="int64")
+        # consecutive blocks are read as one slice
+        run_starts = np.flatnonzero(np.concatenate([[True], np.diff(blocks) != 1]))
+        run_ends = np.concatenate([run_starts[1:], [len(blocks)]])
+        data = np.concatenate([
+            self.postings[self.block_offsets[blocks[s]]: self.block_offsets[blocks[e - 1] + 1]]
+            for s, e in zip(run_starts, run_ends)
+        ])
+        values = varbyte_decode(data)
+
+        sizes = self.block_starts[blocks + 1] - self.block_starts[blocks]
+        value_starts = 2 * (np.cumsum(sizes) - sizes)
+        block_of_posting = np.repeat(np.arange(len(blocks)), sizes)
+        position = np.arange(int(sizes.sum())) - (np.cumsum(sizes) - sizes)[block_of_posting]
+        gaps = values[value_starts[block_of_posting] + position]
+        tfs = values[value_starts[block_of_posting] + sizes[block_of_posting] + position]
+
+        # gaps restart from the last document of the previous block of the same term
+        first_blocks = self.term_blocks[np.searchsorted(self.term_blocks, blocks, side="right") - 1]
+        bases = np.where(blocks == first_blocks, -1, self.block_last[np.maximum(blocks - 1, 0)])
+        cumulative = np.cumsum(gaps)
+        block_totals = np.concatenate([[0], cumulative[np.cumsum(sizes)[:-1] - 1]])
+        docs = cumulative - block_totals[block_of_posting] + bases[block_of_posting]
+        return docs, tfs
+
+    def search(self, query, top_k):
+        """Return the `(docs, scores)` of the `top_k` highest scoring documents for `query`."""
+        terms, query_counts = self.term_ids(tokenize(query))
+        order = np.argsort(-self.max_score[terms] * query_counts, kind="stable")
+        terms, query_counts = terms[order], query_counts[order]
+        # highest score the terms from i on can still add to a document
+        remaining = np.concatenate([np.cumsum((self.max_score[terms] * query_counts)[::-1])[::-1], [0]])
+
+        docs = np.empty(0, dtype="int64")
+        scores = np.empty(0, dtype="float32")
+        for i, (term, query_count) in enumerate(zip(terms, query_counts)):
+            threshold = np.partition(scores, len(scores) - top_k)[len(scores) - top_k] if len(scores) >= top_k else 0
+            term_blocks = np.arange(self.term_blocks[term], self.term_blocks[term + 1])
+            if len(scores) >= top_k and threshold >= remaining[i]:
+                # no new document can reach the top k: drop hopeless candidates and only score the rest
+                keep = scores + remaining[i] >= threshold
+                docs, scores = docs[keep], scores[keep]
+                needed = np.unique(np.searchsorted(self.block_last[term_blocks], docs))
+                term_docs, tfs = self.decode_blocks(term_blocks[needed[needed < len(term_blocks)]])
+                pos = np.minimum(np.searchsorted(term_docs, docs), max(len(term_docs) - 1, 0))
+                found = term_docs[pos] == docs if len(term_docs) else np.zeros(len(docs), dtype=bool)
+                scores[found] += query_count * self.term_scores(term, docs[found], tfs[pos[found]])
+            else:
+                term_docs, tfs = self.decode_blocks(term_blocks)
+                all_docs = np.concatenate([docs, term_docs])
+                all_scores = np.concatenate([scores, query_count * self.term_scores(term, term_docs, tfs)])
+                docs, inverse = np.unique(all_docs, return_inverse=True)
+                scores = np.bincount(inverse, weights=all_scores, minlength=len(docs)).astype("float32")
+
+        top = np.argsort(-scores, kind="stable")[:top_k]
+        return docs[top], scores[top]
+
+    @staticmethod
+    def build(passages_path, index_dir, k1=0.9, b=0.4, block_size=128, title=False, chunk_postings=1 << 22):
+        """Index the passages of a .tsv or .jsonl file into `index_dir`.
+
+        Postings are spilled to disk in runs of `chunk_postings` while the passages are read, and
+        then sorted and compressed one range of terms of about `chunk_postings` postings at a time.
+        Only the vocabulary, the per-document and per-block arrays and one range of postings are held
+        in memory, rather than every posting.
+        """
+        os.makedirs(index_dir, exist_ok=True)
+        runs_dir = os.path.join(index_dir, "runs")
+        os.makedirs(runs_dir, exist_ok=True)
+        vocab, ids, doc_lengths, run_paths = {}, [], [], []
+        term_buffer, doc_buffer, tf_buffer = [], [], []
+
+        def flush():
+            run_path = os.path.join(runs_dir, f"{len(run_paths)}.npy")
+            np.save(run_path, np.array([term_buffer, doc_buffer, tf_buffer], dtype="int32").reshape(3, -1))
+            run_paths.append(run_path)
+            del term_buffer[:], doc_buffer[:], tf_buffer[:]
+
+        for doc, passage in enumerate(src.data.iter_passages(passages_path)):
+            text = passage["title"] + " " + passage["text"] if title else passage["text"]
+            tokens = tokenize(text)
+            ids.append(str(passage["id"]))
+            doc_lengths.append(len(tokens))
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, count in counts.items():
+                term_buffer.append(vocab.setdefault(token, len(vocab)))
+                doc_buffer.append(doc)
+                tf_buffer.append(count)
+            if len(term_buffer) >= chunk_postings:
+                flush()
+        flush()
+
+        # renumber terms in sorted order and sort every run by term (documents stay in order)
+        terms = np.array(list(vocab), dtype=str)
+        del vocab
+        term_order = np.argsort(terms, kind="stable")
+        rank = np.empty(len(terms), dtype="int32")
+        rank[term_order] = np.arange(len(terms), dtype="int32")
+        n_terms = len(terms)
+        df = np.zeros(n_terms, dtype="int64")
+        for run_path in run_paths:
+            run = np.load(run_path)
+            run[0] = rank[run[0]]
+            run = run[:, np.argsort(run[0], kind="stable")]
+            df += np.bincount(run[0], minlength=n_terms)
+            np.save(run_path, run)
+        runs = [np.load(run_path, mmap_mode="r") for run_path in run_paths]
+
+        doc_lengths = np.array(doc_lengths, dtype="int32")
+        n_docs = len(doc_lengths)
+        avgdl = float(doc_lengths.mean()) if n_docs else 0.0
+        idf = np.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+        term_starts = np.concatenate([[0], np.cumsum(df)])
+
+        # blocks of `block_size` postings within each term
+        blocks_per_term = (df + block_size - 1) // block_size
+        term_blocks = np.concatenate([[0], np.cumsum(blocks_per_term)])
+        block_term = np.repeat(np.arange(n_terms), blocks_per_term)
+        block_starts = np.append(
+            term_starts[block_term] + (np.arange(len(block_term)) - term_blocks[block_term]) * block_size,
+            term_starts[-1],
+        )
+        block_offsets = np.zeros(len(block_starts), dtype="int64")
+        block_last = np.empty(len(block_term), dtype="int64")
+        max_score = np.zeros(n_terms, dtype="float32")
+
+        with open(os.path.join(index_dir, "postings.bin"), "wb") as fout:
+            t0 = 0
+            while t0 < n_terms:
+                t1 = max(t0 + 1, int(np.searchsorted(term_starts, term_starts[t0] + chunk_postings, side="right")) - 1)
+                t1 = min(t1, n_terms)
+                # postings of terms t0..t1, gathered from the runs in document order
+                slices = [run[:, np.searchsorted(run[0], t0): np.searchsorted(run[0], t1)] for run in runs]
+                postings = np.concatenate(slices, axis=1)
+                postings = postings[:, np.argsort(postings[0], kind="stable")]
+                posting_terms = postings[0].astype("int64")
+                posting_docs = postings[1].astype("int64")
+                posting_tfs = postings[2].astype("int64")
+                del slices, postings
+
+                b0, b1 = term_blocks[t0], term_blocks[t1]
+                starts = block_starts[b0: b1 + 1] - term_starts[t0]
+                sizes = np.diff(starts)
+                block_of_posting = np.repeat(np.arange(b1 - b0), sizes)
+                in_block = np.arange(len(posting_terms)) - starts[block_of_posting]
+                first_of_term = np.arange(len(posting_terms)) == term_starts[posting_terms] - term_starts[t0]
+                gaps = np.where(first_of_term, posting_docs + 1, posting_docs - np.concatenate([[0], posting_docs[:-1]]))
+                # per block: all gaps, then all term frequencies
+                values = np.empty(2 * len(posting_terms), dtype="int64")
+                values[2 * starts[block_of_posting] + in_block] = gaps
+                values[2 * starts[block_of_posting] + sizes[block_of_posting] + in_block] = posting_tfs
+                data, n_bytes = varbyte_encode(values)
+                byte_offsets = np.concatenate([[0], np.cumsum(n_bytes)])
+                block_offsets[b0 + 1: b1 + 1] = block_offsets[b0] + byte_offsets[2 * starts[1:]]
+                block_last[b0:b1] = posting_docs[starts[1:] - 1]
+                data.tofile(fout)
+
+                norm = k1 * (1 - b + b * doc_lengths[posting_docs] / max(avgdl, 1e-12))
+                scores = idf[posting_terms] * posting_tfs * (k1 + 1) / (posting_tfs + norm)
+                np.maximum.at(max_score, posting_terms, scores.astype("float32"))
+                t0 = t1
+        del runs
+        shutil.rmtree(runs_dir)
+
+        arrays = {
+            "terms": terms[term_order],
+            "df": df,
+            # rounded up so the bound stays above every float32 score
+            "max_score": np.nextafter(max_score, np.float32(np.inf)),
+            "term_blocks": term_blocks.astype("int64"),
+            "block_starts": block_starts.astype("int64"),
+            "block_offsets": block_offsets,
+            "block_last": block_last,
+            "doc_lengths": doc_lengths,
+            "ids": np.array(ids, dtype=str),
+        }
+        for name, array in arrays.items():
+            np.save(os.path.join(index_dir, name + ".npy"), array)
+        meta = {"k1": k1, "b": b, "n_docs": n_docs, "avgdl": avgdl, "block_size": block_size, "title": title,
+                "n_postings": int(term_starts[-1]), "source": _source_stat(passages_path)}
+        with open(os.path.join(index_dir, "meta.json"), "w") as fout:
+            json.dump(meta, fout, indent=1)
+        return BM25Index(index_dir)
+
+def open_bm25_index(passages_path, index_dir=None, k1=0.9, b=0.4, title=False):
+    """Open the BM25 index of `passages_path`, (re)building it if it is missing or out of date.
+
+    The index is kept in `{passages_path}.bm25` unless `index_dir` is given.
+    """
+    index_dir = index_dir or passages_path + ".bm25"
+    meta_path = os.path.join(index_dir, "meta.json")
+    if os.path.exists(meta_path):
+        with open(meta_path) as fin:
+            meta = json.load(fin)
+        if meta["source"] == _source_stat(passages_path) and (meta["k1"], meta["b"], meta["title"]) == (k1, b, title):
+            return BM25Index(index_dir)
+    print(f"Building BM25 index {index_dir} from {passages_path}")
+    tmp_dir = index_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    BM25Index.build(passages_path, tmp_dir, k1=k1, b=b, title=title)
+    shutil.rmtree(index_dir, ignore_errors=True)
+    os.replace(tmp_dir, index_dir)
+    return BM25Index(index_dir)
+
+
+def _source_stat(path):
+    return {"path": os.path.abspath(path), "size": os.path.getsize(path), "mtime": os.path.getmtime(path)}
@@ -0,0 +1,214 @@
+import io
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+import numpy as np
+
+
+def make_key(settings, text):
+    """16-byte digest of `text` and of the settings its cached value depends on."""
+    content = "\x1f".join([str(setting) for setting in settings] + [text])
+    return hashlib.blake2b(content.encode("utf-8"), digest_size=16).digest()
+
+
+def file_fingerprint(paths):
+    """Digest of the path, size and modification time of every existing file of `paths`."""
+    stats = []
+    for path in paths:
+        if os.path.exists(path):
+            stat = os.stat(path)
+            stats.append(f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}")
+    return hashlib.blake2b("\n".join(stats).encode("utf-8"), digest_size=16).hexdigest()
+
+
+class SQLiteLRUCache(object):
+    """Key/value store in a SQLite file, evicting the least recently used entries.
+
+    Values are bytes. Once the stored values exceed `max_size_mb`, the entries that were read or
+    written longest ago are removed. Safe to share between threads of one process, and between
+    processes through SQLite's file locking.
+    """
+
+    def __init__(self, path, max_size_mb=1024):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_size = int(max_size_mb * 2**20)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries (key BLOB PRIMARY KEY, value BLOB, size INTEGER, last_used REAL)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def get_many(self, keys):
+        """Return a dict holding the value of every key of `keys` that is cached."""
+        found = {}
+        with self.lock, self.connection:
+            # stay below SQLite's limit on the number of query parameters
+            for start in range(0, len(keys), 500):
+                chunk = list(keys[start: start + 500])
+                placeholders = ",".join("?" * len(chunk))
+                rows = self.connection.execute(
+                    f"SELECT key, value FROM entries WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                found.update((bytes(key), value) for key, value in rows)
+                self.connection.execute(
+                    f"UPDATE entries SET last_used = ? WHERE key IN ({placeholders})", [time.time()] + chunk
+                )
+        return found
+
+    def put_many(self, keys, values):
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                [(key, value, len(value), now) for key, value in zip(keys, values)],
+            )
+            self._evict()
+
+    def _evict(self):
+        excess = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0] - self.max_size
+        if excess <= 0:
+            return
+        evicted = []
+        for key, size in self.connection.execute("SELECT key, size FROM entries ORDER BY last_used"):
+            evicted.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        self.connection.executemany("DELETE FROM entries WHERE key = ?", evicted)
+
+
+class QueryEmbeddingCache(object):
+    """Cache of query embeddings keyed on the encoder settings and the query text."""
+
+    def __init__(self, path, settings, max_size_mb=1024):
+        self.store = SQLiteLRUCache(path, max_size_mb)
+        self.settings = settings
+
+    def keys(self, texts):
+        return [make_key(self.settings, text) for text in texts]
+
+    def get_many(self, keys):
+        return {key: np.frombuffer(value, dtype="float32") for key, value in self.store.get_many(keys).items()}
+
+    def put_many(self, keys, embeddings):
+        self.store.put_many(keys, [np.asarray(embedding, dtype="float32").tobytes() for embedding in embeddings])
+
+
+class ResultCache(object):
+    """Cache of per-query search results keyed on the index, the search settings and the query text.
+
+    A cached result is the `(ids, scores, indexes)` row of one query in a `SearchResults`.
+    """
+
+    def __init__(self, path, max_size_mb=1024):
+        self.store = SQLiteLRUCache(path, max_size_mb)
+
+    def keys(self, settings, texts):
+        return [make_key(settings, text) for text in texts]
+
+    def get_many(self, keys):
+        found = {}
+        for key, value in self.store.get_many(keys).items():
+            arrays = np.load(io.BytesIO(value))
+            found[key] = (arrays["ids"], arrays["scores"], arrays["indexes"])
+        return found
+
+    def put_many(self, keys, rows):
+        values = []
+        for ids, scores, indexes in rows:
+            buffer = io.BytesIO()
+            np.savez(buffer, ids=ids, scores=scores, indexes=indexes)
+            values.append(buffer.getvalue())
+        self.store.put_many(keys, values)
+
+
+class SemanticCache(object):
+    """In-memory cache of recent query results, matched by embedding similarity.
+
+    The normalized embeddings of the last `capacity` cached queries are kept in a ring buffer. A
+    query whose cosine similarity with a cached query reaches `threshold` gets that query's
+    payload. Entries are addressed by an id that stays valid until their slot is overwritten.
+    """
+
+    def __init__(self, dim, capacity=1024, threshold=0.95):
+        self.embeddings = np.zeros((capacity, dim), dtype="float32")
+        self.payloads = [None] * capacity
+        self.entry_ids = np.full(capacity, -1, dtype="int64")
+        self.threshold = threshold
+        self.next_id = 0
+        self.hits, self.misses = 0, 0
+        self.lock = threading.Lock()
+
+    def lookup(self, embeddings, accept=None):
+        """Return `(entry_id, payload)` of the closest cached query for each row, or None.
+
+        `accept(row, payload)` can reject a match, e.g. a cached result that is too short.
+        """
+        embeddings = _normalize(embeddings)
+        with self.lock:
+            filled = self.entry_ids >= 0
+            if not filled.any():
+                self.misses += len(embeddings)
+                return [None] * len(embeddings)
+            similarities = embeddings @ self.embeddings[filled].T
+            best = similarities.argmax(axis=1)
+            slots = np.flatnonzero(filled)[best]
+            matches = []
+            for row, slot in enumerate(slots):
+                if similarities[row, best[row]] >= self.threshold and (
+                    accept is None or accept(row, self.payloads[slot])
+                ):
+                    matches.append((int(self.entry_ids[slot]), self.payloads[slot]))
+                else:
+                    matches.append(None)
+            n_hits = sum(match is not None for match in matches)
+            self.hits += n_hits
+            self.misses += len(matches) - n_hits
+            return matches
+
+    def add(self, embedding, payload):
+        """Cache `payload` for a query, overwriting the oldest entry when full; returns its entry id."""
+        with self.lock:
+            entry_id = self.next_id
+            slot = entry_id % len(self.payloads)
+            self.embeddings[slot] = _normalize(embedding[None])[0]
+            self.payloads[slot] = payload
+            self.entry_ids[slot] = entry_id
+            self.next_id += 1
+            return entry_id
+
+    def update(self, entry_id, **fields):
+        """Add `fields` to the payload of an entry; returns False if it was evicted."""
+        with self.lock:
+            slot = entry_id % len(self.payloads)
+            if self.entry_ids[slot] != entry_id:
+                return False
+            self.payloads[slot].update(fields)
+            return True
+
+    def metrics(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": int((self.entry_ids >= 0).sum()),
+                "capacity": len(self.payloads),
+            }
+
+
+def _normalize(embeddings):
+    embeddings = np.asarray(embeddings, dtype="float32")
+    return embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
@@ -0,0 +1,133 @@
+import os
+import json
+import shutil
+
+import numpy as np
+
+import src.cache
+import src.embeddings
+import src.index
+import src.papers
+
+
+class PaperCascade(object):
+    """Two-stage dense search: pick the top papers by their paper vectors, then score only their chunks.
+
+    Chunk rows are grouped by paper (the pid in the title column of the passages file):
+    `rows[starts[p]:starts[p + 1]]` are the embedding rows of paper `pids[p]`. The flat paper index
+    holds one vector per paper, the mean of its rows in the paper-level embeddings (for instance its
+    abstract chunks) or of its chunk embeddings. `search_knn` returns `SearchResults` like `Indexer.search_knn`, with
+    `indexes` holding the chunk rows.
+    """
+
+    def __init__(self, cascade_dir, embedding_files, n_papers):
+        self.n_papers = n_papers
+        self.pids = np.load(os.path.join(cascade_dir, "pids.npy"))
+        self.starts = np.load(os.path.join(cascade_dir, "starts.npy"))
+        self.rows = np.load(os.path.join(cascade_dir, "rows.npy"))
+        self.paper_index = src.index.Indexer(0)
+        self.paper_index.deserialize_from(cascade_dir)
+        self.embeddings = src.embeddings.EmbeddingFiles(embedding_files)
+
+    def search_knn(self, query_vectors, top_docs):
+        query_vectors = query_vectors.astype("float32")
+        papers = self.paper_index.search_knn(query_vectors, min(self.n_papers, len(self.pids))).indexes
+        scores = np.full((len(query_vectors), top_docs), -np.inf, dtype="float32")
+        indexes = np.full((len(query_vectors), top_docs), -1, dtype="int64")
+        for q_i, query in enumerate(query_vectors):
+            selected = papers[q_i][papers[q_i] >= 0]
+            rows = np.concatenate([self.rows[:0]] + [self.rows[self.starts[p]: self.starts[p + 1]] for p in selected])
+            chunk_scores = self.embeddings.rows(rows) @ query
+            top = np.argsort(-chunk_scores, kind="stable")[:top_docs]
+            scores[q_i, : len(top)], indexes[q_i, : len(top)] = chunk_scores[top], rows[top]
+        db_ids = self.embeddings.ids[indexes]
+        db_ids[indexes < 0] = ""
+        return src.index.SearchResults(db_ids, scores, indexes)
+
+    def reconstruct(self, indexes):
+        """Return the chunk embeddings of the rows `indexes` returned by `search_knn`."""
+        return self.embeddings.rows(indexes)
+
+    @staticmethod
+    def build(cascade_dir, embedding_files, passages_path, paper_embedding_files=None, paper_passages_path=None):
+        """Group the chunk rows of `embedding_files` by pid and index one vector per paper in `cascade_dir`."""
+        os.makedirs(cascade_dir, exist_ok=True)
+        chunk_pids = _pids_of_rows(embedding_files, passages_path)
+        pids, paper_of_row = np.unique(chunk_pids, return_inverse=True)
+        rows = np.argsort(paper_of_row, kind="stable")
+        starts = np.concatenate([[0], np.cumsum(np.bincount(paper_of_row, minlength=len(pids)))])
+
+        if paper_embedding_files:
+            paper_pids = _pids_of_rows(paper_embedding_files, paper_passages_path)
+            # papers without chunks cannot be searched, drop them
+            paper_of_paper_row = np.searchsorted(pids, paper_pids)
+            known = paper_of_paper_row < len(pids)
+            known[known] = pids[paper_of_paper_row[known]] == paper_pids[known]
+            paper_of_paper_row[~known] = -1
+            vectors, counts = _mean_by_paper(paper_embedding_files, paper_of_paper_row, len(pids))
+            missing = counts == 0
+            if missing.any():
+                print(f"{missing.sum()} of {len(pids)} papers have no paper embedding, using their mean chunk embedding")
+                vectors[missing] = _mean_by_paper(embedding_files, paper_of_row, len(pids))[0][missing]
+        else:
+            vectors = _mean_by_paper(embedding_files, paper_of_row, len(pids))[0]
+
+        paper_index = src.index.Indexer(vectors.shape[1])
+        paper_index.index_data(pids, vectors)
+        paper_index.serialize(cascade_dir)
+        np.save(os.path.join(cascade_dir, "pids.npy"), pids)
+        np.save(os.path.join(cascade_dir, "starts.npy"), starts.astype("int64"))
+        np.save(os.path.join(cascade_dir, "rows.npy"), rows.astype("int64"))
+
+
+def _pids_of_rows(embedding_files, passages_path):
+    """Return the pid (passage title) of every embedding row of `embedding_files`."""
+    ids = np.concatenate([src.embeddings.load_embeddings(file_path)[0] for file_path in embedding_files])
+    return src.papers.pids_of(ids, passages_path)
+
+
+def _mean_by_paper(embedding_files, paper_of_row, n_papers):
+    """Mean embedding of every paper, rows with paper -1 are skipped. Returns the means and row counts."""
+    sums, counts, start = None, np.zeros(n_papers, dtype="int64"), 0
+    for file_path in embedding_files:
+        _, embeddings = src.embeddings.load_embeddings(file_path)
+        papers = paper_of_row[start: start + len(embeddings)]
+        start += len(embeddings)
+        if sums is None:
+            sums = np.zeros((n_papers, embeddings.shape[1]), dtype="float64")
+        order = np.argsort(papers, kind="stable")
+        order = order[papers[order] >= 0]
+        if len(order) == 0:
+            continue
+        file_papers, first = np.unique(papers[order], return_index=True)
+        sums[file_papers] += np.add.reduceat(np.asarray(embeddings[order], dtype="float64"), first, axis=0)
+        counts[file_papers] += np.diff(np.append(first, len(order)))
+    return (sums / np.maximum(counts, 1)[:, None]).astype("float32"), counts
+
+
+def open_cascade(embedding_files, passages_path, n_papers, paper_embedding_files=None, paper_passages_path=None,
+                 cascade_dir=None):
+    """Open the cascade of `embedding_files`, (re)building it if any of its input files changed.
+
+    The cascade is kept in a `cascade` directory next to the embeddings unless `cascade_dir` is given.
+    """
+    cascade_dir = cascade_dir or os.path.join(os.path.dirname(embedding_files[0]), "cascade")
+    paper_embedding_files = paper_embedding_files or []
+    inputs = list(embedding_files) + [passages_path] + list(paper_embedding_files)
+    if paper_embedding_files:
+        inputs.append(paper_passages_path)
+    source = {"fingerprint": src.cache.file_fingerprint(inputs)}
+    meta_path = os.path.join(cascade_dir, "meta.json")
+    if os.path.exists(meta_path):
+        with open(meta_path) as fin:
+            if json.load(fin) == source:
+                return PaperCascade(cascade_dir, embedding_files, n_papers)
+    print(f"Building paper cascade {cascade_dir} from {passages_path}")
+    tmp_dir = cascade_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    PaperCascade.build(tmp_dir, embedding_files, passages_path, paper_embedding_files, paper_passages_path)
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as fout:
+        json.dump(source, fout)
+    shutil.rmtree(cascade_dir, ignore_errors=True)
+    os.replace(tmp_dir, cascade_dir)
+    return PaperCascade(cascade_dir, embedding_files, n_papers)
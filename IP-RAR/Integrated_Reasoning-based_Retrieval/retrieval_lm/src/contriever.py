@@ -100,6 +100,30 @@ class XLMRetriever(XLMRobertaModel):
         return emb
 
 
+def default_device(int8=False):
+    # int8 dynamic quantization only runs on cpu
+    return "cuda" if torch.cuda.is_available() and not int8 else "cpu"
+
+
+def prepare_for_inference(model, device=None, fp16=True, int8=False):
+    """Move `model` to `device` in eval mode.
+
+    On GPU the model runs in fp16 unless `fp16=False`. On CPU it stays in fp32, or with `int8=True`
+    the linear layers of the encoder are replaced by int8 dynamically quantized ones; `int8=True`
+    without a `device` runs on cpu.
+    """
+    device = device or default_device(int8)
+    model.eval()
+    if int8:
+        if device != "cpu":
+            raise ValueError("int8 dynamic quantization is only supported on cpu")
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    model = model.to(device)
+    if fp16 and device != "cpu":
+        model = model.half()
+    return model
+
+
 def load_retriever(model_path, pooling="average", random_init=False):
     # try: check if model exists locally
     path = os.path.join(model_path, "checkpoint.pth")
@@ -224,21 +224,107 @@ def add_bos_eos(x, bos_token_id, eos_token_id):
 
 
 # Used for passage retrieval
-def load_passages(path):
+def load_passages(path, shard_id=0, num_shards=1, byte_range=None):
+    """Load passages from a .tsv or .jsonl file.
+
+    With `num_shards` > 1 only the records starting in the `shard_id`-th of `num_shards` equal byte
+    ranges of the file are parsed, so shards can be loaded in parallel. Concatenating the shards in
+    order gives the passages of the full file, also when quoted .tsv fields contain newlines.
+    `byte_range` gives the `(start, end)` offsets of the records to parse directly, as returned by
+    `shard_byte_ranges`, so workers need not scan the file before their range.
+    """
     if not os.path.exists(path):
         logger.info(f"{path} does not exist")
         return
     logger.info(f"Loading passages from: {path}")
-    passages = []
+    return list(iter_passages(path, shard_id, num_shards, byte_range))
+
+
+def iter_passages(path, shard_id=0, num_shards=1, byte_range=None):
+    """Yield the passages returned by `load_passages` one at a time."""
+    if byte_range is None and num_shards > 1:
+        byte_range = shard_byte_ranges(path, num_shards, [shard_id])[0]
     with open(path) as fin:
+        if byte_range is None:
+            lines = fin
+        else:
+            lines = _read_byte_range(path, *byte_range)
         if path.endswith(".jsonl"):
-            for k, line in enumerate(fin):
+            for k, line in enumerate(lines):
                 ex = json.loads(line)
-                passages.append(ex)
+                yield ex
         else:
-            reader = csv.reader(fin, delimiter="\t")
+            reader = csv.reader(lines, delimiter="\t")
             for k, row in enumerate(reader):
                 if not row[0] == "id":
                     ex = {"id": row[0], "title": row[2], "text": row[1]}
-                    passages.append(ex)
-    return passages
+                    yield ex
+
+
+def shard_byte_ranges(path, num_shards, shard_ids):
+    """Return the `(start, end)` byte offsets of the records of each of `shard_ids`.
+
+    A shard holds the records whose first byte lies in its equal `1 / num_shards` byte range of the
+    file, so the offsets of all requested shards are found in one pass over the file.
+    """
+    size = os.path.getsize(path)
+    positions = sorted({size * k // num_shards for shard_id in shard_ids for k in (shard_id, shard_id + 1)})
+    offsets = dict(zip(positions, record_starts(path, positions, quoted=not path.endswith(".jsonl"))))
+    return [
+        (offsets[size * shard_id // num_shards], offsets[size * (shard_id + 1) // num_shards]) for shard_id in shard_ids
+    ]
+
+
+def record_starts(path, positions, quoted=False, block_size=2**24):
+    """Return the offset of the first record of `path` starting at or after each of the sorted `positions`.
+
+    Records are lines, or with `quoted` csv rows whose quoted fields may span lines. Fields are
+    assumed to be quoted as by `csv.writer`, with quotes inside them doubled, so a newline ends a
+    record exactly when an even number of quote characters precede it in the file. Quoted files
+    are read once from the start up to the last record start found.
+    """
+    size = os.path.getsize(path)
+    starts = []
+    with open(path, "rb") as fin:
+        if not quoted:
+            for position in positions:
+                if position <= 0:
+                    starts.append(0)
+                    continue
+                fin.seek(position - 1)
+                fin.readline()
+                starts.append(fin.tell())
+            return starts
+        positions = list(positions)
+        while positions and positions[0] <= 0:
+            starts.append(0)
+            positions.pop(0)
+        offset, n_quotes = 0, 0
+        while positions:
+            block = np.frombuffer(fin.read(block_size), dtype="uint8")
+            if len(block) == 0:
+                break
+            quotes = np.flatnonzero(block == ord('"'))
+            newlines = np.flatnonzero(block == ord("\n"))
+            # newlines preceded by an even number of quotes end a record
+            record_ends = newlines[(n_quotes + np.searchsorted(quotes, newlines)) % 2 == 0]
+            block_starts = offset + record_ends + 1
+            # positions are sorted, so those with a record start in this block come first
+            found = np.searchsorted(block_starts, positions)
+            n_found = int((found < len(block_starts)).sum())
+            starts.extend(block_starts[found[:n_found]].tolist())
+            positions = positions[n_found:]
+            offset += len(block)
+            n_quotes += len(quotes)
+    return starts + [size] * len(positions)
+
+
+def _read_byte_range(path, start, end):
+    # yield the lines between two record starts
+    with open(path, "rb") as fin:
+        fin.seek(start)
+        while fin.tell() < end:
+            line = fin.readline()
+            if not line:
+                break
+            yield line.decode("utf-8")
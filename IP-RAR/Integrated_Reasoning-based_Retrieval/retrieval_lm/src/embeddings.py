@@ -0,0 +1,254 @@
+import os
+import glob
+import json
+import pickle
+
+import numpy as np
+
+
+class EmbeddingWriter(object):
+    """Streams passage embeddings to fixed-size .npy files as they are produced.
+
+    Every `embeddings_per_file` rows are written to `{prefix}_{part:05d}.npy` (float32) with the
+    passage ids in `{prefix}_{part:05d}_ids.npy`. `close` writes a `{prefix}.json` manifest listing
+    the parts, which can be passed to the retrieval scripts instead of a glob.
+
+    The manifest is also rewritten after every part as a checkpoint. With `resume=True` the parts
+    recorded there are kept and `total` tells how many leading passages can be skipped.
+    """
+
+    def __init__(self, output_dir, prefix, embeddings_per_file=50000, expected_total=None, resume=False,
+                 ids_dtype=str):
+        self.output_dir = output_dir
+        self.ids_dtype = ids_dtype
+        self.prefix = prefix
+        self.embeddings_per_file = embeddings_per_file
+        self.expected_total = expected_total
+        self.parts = []
+        self.total = 0
+        self.dim = None
+        self.buffer_ids, self.buffer_embeddings, self.buffer_size = [], [], 0
+        os.makedirs(output_dir, exist_ok=True)
+        if resume and os.path.exists(self.manifest_path):
+            self._load_checkpoint()
+
+    def add(self, ids, embeddings):
+        embeddings = np.asarray(embeddings, dtype="float32")
+        self.dim = embeddings.shape[1]
+        self.buffer_ids.extend(ids)
+        self.buffer_embeddings.append(embeddings)
+        self.buffer_size += len(embeddings)
+        while self.buffer_size >= self.embeddings_per_file:
+            self._write_part(self.embeddings_per_file)
+
+    def close(self):
+        if self.buffer_size > 0:
+            self._write_part(self.buffer_size)
+        self.verify()
+        return self._write_manifest(complete=True)
+
+    def verify(self):
+        """Check that every recorded part is on disk with the recorded number of rows."""
+        for part in self.parts:
+            ids, embeddings = load_embeddings(os.path.join(self.output_dir, part["embeddings"]))
+            if len(ids) != part["count"] or embeddings.shape != (part["count"], self.dim):
+                raise ValueError(f"{part['embeddings']} holds {embeddings.shape} embeddings and {len(ids)} ids, "
+                                 f"expected {part['count']} rows of dimension {self.dim}")
+        if self.expected_total is not None and self.total != self.expected_total:
+            raise ValueError(f"{self.total} passages embedded, expected {self.expected_total}")
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.output_dir, self.prefix + ".json")
+
+    def _write_part(self, n):
+        buffer_embeddings = np.concatenate(self.buffer_embeddings, axis=0)
+        ids, embeddings = self.buffer_ids[:n], buffer_embeddings[:n]
+        self.buffer_ids, self.buffer_embeddings = self.buffer_ids[n:], [buffer_embeddings[n:]]
+        self.buffer_size -= n
+
+        name = f"{self.prefix}_{len(self.parts):05d}"
+        # ids first, a part only counts as written once its embeddings file exists
+        _atomic_write(os.path.join(self.output_dir, name + "_ids.npy"),
+                      lambda f: np.save(f, np.asarray(ids, dtype=self.ids_dtype)))
+        _atomic_write(os.path.join(self.output_dir, name + ".npy"), lambda f: np.save(f, embeddings))
+        self.parts.append({"embeddings": name + ".npy", "ids": name + "_ids.npy", "count": n})
+        self.total += n
+        self._write_manifest(complete=False)
+
+    def _write_manifest(self, complete):
+        manifest = {
+            "dim": self.dim,
+            "total": self.total,
+            "expected_total": self.expected_total,
+            "complete": complete,
+            "parts": self.parts,
+        }
+        _atomic_write(self.manifest_path, lambda f: f.write(json.dumps(manifest, indent=1).encode()))
+        return manifest
+
+    def _load_checkpoint(self):
+        with open(self.manifest_path) as fin:
+            manifest = json.load(fin)
+        if self.expected_total is not None and manifest.get("expected_total") not in (None, self.expected_total):
+            raise ValueError(f"{self.manifest_path} was written for {manifest['expected_total']} passages, "
+                             f"not {self.expected_total}; remove it or drop --resume")
+        # keep the leading parts that are fully on disk
+        for part in manifest["parts"]:
+            if not all(os.path.exists(os.path.join(self.output_dir, part[key])) for key in ("embeddings", "ids")):
+                break
+            self.parts.append(part)
+            self.total += part["count"]
+        self.dim = manifest["dim"]
+        print(f"Resuming from {self.manifest_path}: {self.total} passages in {len(self.parts)} files already embedded.")
+
+
+class EmbeddingCache(object):
+    """Embeddings stored once per content key and reused across embedding runs.
+
+    Keys are 16-byte digests of everything that determines an embedding (see
+    `generate_passage_embeddings.passage_key`). The cache is a directory of `EmbeddingWriter` files
+    whose ids are the keys, so identical chunks under different passage ids share one vector.
+    """
+
+    def __init__(self, cache_dir, embeddings_per_file=50000):
+        self.writer = EmbeddingWriter(cache_dir, "cache", embeddings_per_file, resume=True, ids_dtype="S16")
+        self._load_keys()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, keys):
+        """Return the cache row of each key, -1 for keys that are not cached."""
+        keys = np.asarray(keys, dtype="S16")
+        if len(self.keys) == 0:
+            return np.full(len(keys), -1, dtype="int64")
+        pos = np.minimum(np.searchsorted(self.sorted_keys, keys), len(self.keys) - 1)
+        return np.where(self.sorted_keys[pos] == keys, self.order[pos], -1)
+
+    def get(self, rows):
+        """Gather the embeddings of cache rows returned by `lookup`."""
+        return gather_rows(self.files, self.offsets, rows)
+
+    def add(self, keys, embeddings):
+        self.writer.add(keys, embeddings)
+
+    def flush(self):
+        """Write buffered embeddings to disk and make them visible to `lookup`."""
+        self.writer.close()
+        self._load_keys()
+
+    def _load_keys(self):
+        self.files, keys, offsets = [], [], [0]
+        for part in self.writer.parts:
+            part_keys, embeddings = load_embeddings(os.path.join(self.writer.output_dir, part["embeddings"]))
+            self.files.append(embeddings)
+            keys.append(part_keys)
+            offsets.append(offsets[-1] + len(part_keys))
+        self.keys = np.concatenate(keys) if keys else np.empty(0, dtype="S16")
+        self.offsets = np.array(offsets)
+        self.order = np.argsort(self.keys, kind="stable")
+        self.sorted_keys = self.keys[self.order]
+
+
+class EmbeddingFiles(object):
+    """Memory-mapped embedding files read as one array of rows, with lookup by passage id."""
+
+    def __init__(self, embedding_files):
+        self.files, ids, offsets = [], [], [0]
+        for file_path in embedding_files:
+            file_ids, embeddings = load_embeddings(file_path)
+            self.files.append(embeddings)
+            ids.append(file_ids)
+            offsets.append(offsets[-1] + len(file_ids))
+        self.ids = np.concatenate(ids).astype(str)
+        self.offsets = np.array(offsets)
+        self.order = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def rows(self, rows):
+        return gather_rows(self.files, self.offsets, rows)
+
+    def get(self, ids):
+        """Return the embeddings of the passages `ids`."""
+        if self.order is None:
+            self.order = np.argsort(self.ids, kind="stable")
+        ids = np.asarray(ids, dtype=str)
+        pos = np.minimum(np.searchsorted(self.ids[self.order], ids), len(self.ids) - 1)
+        rows = self.order[pos]
+        missing = self.ids[rows] != ids
+        if missing.any():
+            raise KeyError(f"{missing.sum()} passages have no embedding, e.g. {ids[missing][:5].tolist()}")
+        return self.rows(rows)
+
+
+def gather_rows(files, offsets, rows):
+    """Gather `rows` of embedding arrays read one after the other, `offsets[i]` being the first row of `files[i]`."""
+    rows = np.asarray(rows)
+    part_of_row = np.searchsorted(offsets, rows, side="right") - 1
+    embeddings = np.empty((len(rows), files[0].shape[1] if files else 0), dtype="float32")
+    for part in np.unique(part_of_row):
+        selected = part_of_row == part
+        embeddings[selected] = files[part][rows[selected] - offsets[part]]
+    return embeddings
+
+
+def merge_manifests(manifest_paths, output_path):
+    """Write one manifest listing the parts of `manifest_paths` in order, all in the same directory."""
+    merged = {"dim": None, "total": 0, "expected_total": 0, "complete": True, "parts": []}
+    for path in manifest_paths:
+        with open(path) as fin:
+            manifest = json.load(fin)
+        if os.path.dirname(os.path.abspath(path)) != os.path.dirname(os.path.abspath(output_path)):
+            raise ValueError(f"{path} is not in the directory of {output_path}")
+        if merged["dim"] is not None and manifest["dim"] != merged["dim"]:
+            raise ValueError(f"{path} holds embeddings of dimension {manifest['dim']}, expected {merged['dim']}")
+        merged["dim"] = manifest["dim"]
+        merged["total"] += manifest["total"]
+        merged["expected_total"] += manifest["expected_total"] or manifest["total"]
+        merged["complete"] = merged["complete"] and manifest["complete"]
+        merged["parts"].extend(manifest["parts"])
+    _atomic_write(output_path, lambda f: f.write(json.dumps(merged, indent=1).encode()))
+    return merged
+
+
+def _atomic_write(path, write_fn):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        write_fn(f)
+    os.replace(tmp_path, path)
+
+
+def expand_embedding_files(paths):
+    """Resolve manifests and .npy parts matched by a glob into the list of embedding files to read.
+
+    Id sidecars are skipped and parts listed in a manifest are only returned once, so a glob such
+    as `passages_*` over a directory written by `EmbeddingWriter` reads every embedding once.
+    Other files are treated as pickled `(ids, embeddings)` tuples.
+    """
+    files = []
+    for path in paths:
+        if path.endswith(".json"):
+            with open(path) as fin:
+                manifest = json.load(fin)
+            files.extend(os.path.join(os.path.dirname(path), part["embeddings"]) for part in manifest["parts"])
+        elif not path.endswith("_ids.npy") and not path.endswith(".tmp"):
+            files.append(path)
+    return list(dict.fromkeys(files))
+
+
+def glob_embedding_files(pattern):
+    return expand_embedding_files(sorted(glob.glob(pattern)))
+
+
+def load_embeddings(file_path, mmap=True):
+    """Return `(ids, embeddings)` from one embedding file; .npy parts are memory-mapped."""
+    if file_path.endswith(".npy"):
+        ids = np.load(file_path[: -len(".npy")] + "_ids.npy")
+        embeddings = np.load(file_path, mmap_mode="r" if mmap else None)
+        return ids, embeddings
+    with open(file_path, "rb") as fin:
+        ids, embeddings = pickle.load(fin)
+    return np.asarray(ids, dtype=str), embeddings
@@ -0,0 +1,52 @@
+import numpy as np
+import torch
+
+
+def make_batches(tokenizer, texts, max_length, batch_size, max_tokens=0, sort_by_length=False, text_pairs=None):
+    """Tokenize `texts` (with `text_pairs`, as sentence pairs) and group them into padded batches.
+
+    With `sort_by_length` texts are batched longest first so each batch is padded to a similar
+    length, and with `max_tokens` > 0 a batch is closed once its padded size would exceed
+    `max_tokens` tokens (or `batch_size` texts). Returns a list of `(positions, encoded_batch)`
+    where `positions` are the indices of the batch texts in `texts`.
+    """
+    if text_pairs is not None:
+        # only the second text of a pair is cut, the query is kept whole
+        tokenized = tokenizer(
+            list(texts), list(text_pairs), max_length=max_length, truncation="only_second", padding=False
+        )
+    else:
+        tokenized = tokenizer(list(texts), max_length=max_length, truncation=True, padding=False)
+    lengths = np.array([len(input_ids) for input_ids in tokenized["input_ids"]])
+    if sort_by_length:
+        order = np.argsort(-lengths, kind="stable")
+    else:
+        order = np.arange(len(texts))
+
+    batches = []
+    start = 0
+    while start < len(order):
+        end = min(start + batch_size, len(order))
+        if max_tokens > 0:
+            # padded size of a candidate batch is its size times its longest text
+            padded = np.maximum.accumulate(lengths[order[start:end]]) * np.arange(1, end - start + 1)
+            end = start + max(1, int(np.searchsorted(padded, max_tokens, side="right")))
+        positions = order[start:end]
+        features = [{key: tokenized[key][i] for key in tokenized.keys()} for i in positions]
+        batches.append((positions, tokenizer.pad(features, return_tensors="pt")))
+        start = end
+    return batches
+
+
+@torch.no_grad()
+def encode_batches(model, batches, n_texts):
+    """Run `model` over `make_batches` output and return float32 embeddings in the original text order."""
+    device = next(model.parameters()).device
+    embeddings = None
+    for positions, encoded_batch in batches:
+        encoded_batch = {k: v.to(device) for k, v in encoded_batch.items()}
+        output = model(**encoded_batch).float().cpu().numpy()
+        if embeddings is None:
+            embeddings = np.empty((n_texts, output.shape[1]), dtype="float32")
+        embeddings[positions] = output
+    return embeddings
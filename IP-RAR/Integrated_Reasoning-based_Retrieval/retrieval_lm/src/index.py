@@ -6,68 +6,361 @@
 
 import os
 import pickle
-from typing import List, Tuple
+from typing import List
 
 import faiss
 import numpy as np
 from tqdm import tqdm
 
+INDEX_TYPES = ["flat", "pq", "sq8", "sq_fp16", "ivf_flat", "ivf_pq", "ivf_sq8", "hnsw"]
+
+
+class SearchResults(object):
+    """Top-k hits for a batch of queries, stored as (n_queries, k) arrays.
+
+    `ids` holds the external passage ids, `scores` the similarity scores and `indexes` the
+    positions in the faiss index (-1 where fewer than k hits were found, with an empty id).
+    Indexing with an integer returns the `(ids, scores)` pair of one query, slicing returns
+    a new `SearchResults`.
+    """
+
+    def __init__(self, ids, scores, indexes):
+        self.ids = ids
+        self.scores = scores
+        self.indexes = indexes
+
+    @property
+    def valid(self):
+        return self.indexes >= 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return SearchResults(self.ids[key], self.scores[key], self.indexes[key])
+        return self.ids[key], self.scores[key]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
 class Indexer(object):
 
-    def __init__(self, vector_sz, n_subquantizers=0, n_bits=8):
-        if n_subquantizers > 0:
+    def __init__(self, vector_sz, n_subquantizers=0, n_bits=8, index_type=None, n_list=4096, hnsw_m=32,
+                 ef_construction=200, n_train=262144, seed=0, explicit_ids=False, refine_k_factor=0):
+        if index_type is None:
+            index_type = "pq" if n_subquantizers > 0 else "flat"
+        if index_type == "flat":
+            self.index = faiss.IndexFlatIP(vector_sz)
+        elif index_type == "pq":
             self.index = faiss.IndexPQ(vector_sz, n_subquantizers, n_bits, faiss.METRIC_INNER_PRODUCT)
+        elif index_type == "sq8":
+            self.index = faiss.IndexScalarQuantizer(vector_sz, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+        elif index_type == "sq_fp16":
+            self.index = faiss.IndexScalarQuantizer(vector_sz, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT)
+        elif index_type == "ivf_flat":
+            quantizer = faiss.IndexFlatIP(vector_sz)
+            self.index = faiss.IndexIVFFlat(quantizer, vector_sz, n_list, faiss.METRIC_INNER_PRODUCT)
+        elif index_type == "ivf_pq":
+            assert n_subquantizers > 0, 'ivf_pq requires n_subquantizers > 0'
+            quantizer = faiss.IndexFlatIP(vector_sz)
+            self.index = faiss.IndexIVFPQ(quantizer, vector_sz, n_list, n_subquantizers, n_bits,
+                                          faiss.METRIC_INNER_PRODUCT)
+        elif index_type == "ivf_sq8":
+            quantizer = faiss.IndexFlatIP(vector_sz)
+            self.index = faiss.IndexIVFScalarQuantizer(quantizer, vector_sz, n_list, faiss.ScalarQuantizer.QT_8bit,
+                                                       faiss.METRIC_INNER_PRODUCT)
+        elif index_type == "hnsw":
+            self.index = faiss.IndexHNSWFlat(vector_sz, hnsw_m, faiss.METRIC_INNER_PRODUCT)
+            self.index.hnsw.efConstruction = ef_construction
         else:
-            self.index = faiss.IndexFlatIP(vector_sz)
-        #self.index_id_to_db_id = np.empty((0), dtype=np.int64)
-        self.index_id_to_db_id = []
+            raise ValueError(f'Unknown index type {index_type}, expected one of {INDEX_TYPES}')
+        if refine_k_factor > 0 and explicit_ids:
+            raise ValueError('Refined indexes do not support updates by id, explicit ids are unavailable')
+        if explicit_ids:
+            # ivf indexes store ids in their inverted lists, other indexes need an id map to support removal
+            if index_type == "hnsw":
+                raise ValueError('hnsw indexes do not support removal, explicit ids are unavailable')
+            if not index_type.startswith("ivf"):
+                self.index = faiss.IndexIDMap2(self.index)
+        self.explicit_ids = explicit_ids
+        # the top k * refine_k_factor candidates are rescored with the exact vectors of `set_refine_vectors`
+        self.refine_k_factor = refine_k_factor
+        self.refine_vectors = None
+        self.n_train = n_train
+        self.seed = seed
+        self.index_id_to_db_id = np.empty((0), dtype=str)
+        self.delta_file = None
+
+    @property
+    def is_trained(self):
+        return self.index.is_trained
+
+    def train(self, embeddings):
+        """Train the index on a random sample of at most `n_train` rows of `embeddings`."""
+        if len(embeddings) > self.n_train:
+            rng = np.random.default_rng(self.seed)
+            sample = np.sort(rng.choice(len(embeddings), self.n_train, replace=False))
+            embeddings = embeddings[sample]
+        embeddings = np.ascontiguousarray(embeddings, dtype='float32')
+        print(f'Training index on {len(embeddings)} vectors')
+        self.index.train(embeddings)
+
+    def set_search_params(self, nprobe=None, ef_search=None, refine_k_factor=None):
+        """Set query-time search knobs; knobs that do not apply to the index type are ignored."""
+        if nprobe is not None:
+            ivf = faiss.try_extract_index_ivf(self.index)
+            if ivf is not None:
+                ivf.nprobe = nprobe
+        if ef_search is not None:
+            hnsw = self._find_index(faiss.IndexHNSW)
+            if hnsw is not None:
+                hnsw.hnsw.efSearch = ef_search
+        if refine_k_factor is not None:
+            self.refine_k_factor = refine_k_factor
+
+    def set_refine_vectors(self, vectors):
+        """Rescore candidates with exact vectors, `vectors.rows(positions)` returning those of index positions.
+
+        `vectors` is typically a `src.embeddings.EmbeddingFiles` over the memory-mapped embedding
+        files the index was built from, so only the vectors of the candidates are read.
+        """
+        if self.explicit_ids:
+            raise ValueError('Refined indexes do not support updates by id, this index was built with explicit ids')
+        if len(vectors) != self.index.ntotal:
+            raise ValueError(f'{len(vectors)} refine vectors for an index of size {self.index.ntotal}')
+        self.refine_vectors = vectors
+
+    def reconstruct(self, indexes):
+        """Return the stored vectors of the hits `indexes` of `search_knn`, decoded for quantized indexes."""
+        ivf = faiss.try_extract_index_ivf(self.index)
+        if ivf is not None and ivf.direct_map.type == faiss.DirectMap.NoMap:
+            # ivf indexes need a map from ids to list entries, built once
+            ivf.set_direct_map_type(faiss.DirectMap.Hashtable if self.explicit_ids else faiss.DirectMap.Array)
+        return self.index.reconstruct_batch(np.asarray(indexes, dtype='int64'))
+
+    def make_id_selector(self, db_ids):
+        """Return a faiss selector that only admits the passages `db_ids`, for `search_knn`."""
+        if self.explicit_ids:
+            return faiss.IDSelectorBatch(self._to_labels(db_ids))
+        # positions in the index are the faiss labels, one bit per position
+        allowed = np.isin(self.index_id_to_db_id, np.asarray(db_ids, dtype=str))
+        bitmap = np.packbits(allowed, bitorder='little')
+        selector = faiss.IDSelectorBitmap(len(allowed), faiss.swig_ptr(bitmap))
+        selector.bitmap_array = bitmap  # faiss does not own the bitmap, keep it alive with the selector
+        return selector
+
+    def _search_params(self, id_selector):
+        # search parameters override the index settings, so carry over the current knobs
+        ivf = faiss.try_extract_index_ivf(self.index)
+        hnsw = self._find_index(faiss.IndexHNSW)
+        if ivf is not None:
+            params = faiss.SearchParametersIVF(sel=id_selector, nprobe=ivf.nprobe)
+        elif hnsw is not None:
+            params = faiss.SearchParametersHNSW(sel=id_selector, efSearch=hnsw.hnsw.efSearch)
+        elif self._find_index(faiss.IndexPQ) is not None:
+            raise ValueError('pq indexes do not support filtered search, use ivf_pq or sq8')
+        else:
+            params = faiss.SearchParameters(sel=id_selector)
+        return params
+
+    def _find_index(self, index_class):
+        # walk down id maps to the first index of the requested class
+        index = faiss.downcast_index(self.index)
+        while not isinstance(index, index_class):
+            if isinstance(index, faiss.IndexIDMap):
+                index = faiss.downcast_index(index.index)
+            else:
+                return None
+        return index
 
     def index_data(self, ids, embeddings):
+        if self.explicit_ids:
+            self._add_with_ids(self._to_labels(ids), embeddings)
+            print(f'Total data indexed {self.index.ntotal}')
+            return
         self._update_id_mapping(ids)
-        embeddings = embeddings.astype('float32')
+        embeddings = np.ascontiguousarray(embeddings, dtype='float32')
         if not self.index.is_trained:
-            self.index.train(embeddings)
+            self.train(embeddings)
         self.index.add(embeddings)
 
         print(f'Total data indexed {len(self.index_id_to_db_id)}')
 
-    def search_knn(self, query_vectors: np.array, top_docs: int, index_batch_size: int = 2048) -> List[Tuple[List[object], List[float]]]:
+    def search_knn(self, query_vectors: np.array, top_docs: int, index_batch_size: int = 2048,
+                   id_selector=None) -> 'SearchResults':
+        """Return the top `top_docs` passages of each query, only among those admitted by `id_selector` if given."""
         query_vectors = query_vectors.astype('float32')
-        result = []
+        params = self._search_params(id_selector) if id_selector is not None else None
+        n_fetch = top_docs
+        if self.refine_vectors is not None and self.refine_k_factor > 1:
+            n_fetch = top_docs * self.refine_k_factor
+        scores = np.empty((len(query_vectors), n_fetch), dtype='float32')
+        indexes = np.empty((len(query_vectors), n_fetch), dtype='int64')
         nbatch = (len(query_vectors)-1) // index_batch_size + 1
-        for k in tqdm(range(nbatch)):
+        for k in tqdm(range(nbatch), disable=nbatch == 1):
             start_idx = k*index_batch_size
             end_idx = min((k+1)*index_batch_size, len(query_vectors))
             q = query_vectors[start_idx: end_idx]
-            scores, indexes = self.index.search(q, top_docs)
-            # convert to external ids
-            db_ids = [[str(self.index_id_to_db_id[i]) for i in query_top_idxs] for query_top_idxs in indexes]
-            result.extend([(db_ids[i], scores[i]) for i in range(len(db_ids))])
-        return result
+            scores[start_idx:end_idx], indexes[start_idx:end_idx] = self.index.search(q, n_fetch, params=params)
+        if n_fetch > top_docs:
+            scores, indexes = self._refine(query_vectors, indexes, top_docs)
+        # convert to external ids for the whole batch at once
+        if self.explicit_ids:
+            db_ids = indexes.astype(str)
+        else:
+            db_ids = np.asarray(self.index_id_to_db_id)[indexes]
+        db_ids[indexes < 0] = ''
+        return SearchResults(db_ids, scores, indexes)
+
+    def _refine(self, query_vectors, indexes, top_docs, batch_size=64):
+        # exact inner product of every candidate with its query, in batches to bound the gathered vectors
+        scores = np.full(indexes.shape, -np.inf, dtype='float32')
+        for start_idx in range(0, len(indexes), batch_size):
+            batch = indexes[start_idx: start_idx + batch_size]
+            valid = batch >= 0
+            vectors = self.refine_vectors.rows(batch[valid])
+            queries = query_vectors[start_idx: start_idx + batch_size][np.nonzero(valid)[0]]
+            scores[start_idx: start_idx + batch_size][valid] = np.einsum('ij,ij->i', vectors, queries)
+        top = np.argsort(-scores, axis=1, kind='stable')[:, :top_docs]
+        return np.take_along_axis(scores, top, axis=1), np.take_along_axis(indexes, top, axis=1)
 
     def serialize(self, dir_path):
         index_file = os.path.join(dir_path, 'index.faiss')
-        meta_file = os.path.join(dir_path, 'index_meta.faiss')
+        meta_file = os.path.join(dir_path, 'index_meta.npy')
         print(f'Serializing index to {index_file}, meta data to {meta_file}')
 
         faiss.write_index(self.index, index_file)
-        with open(meta_file, mode='wb') as f:
-            pickle.dump(self.index_id_to_db_id, f)
+        if self.explicit_ids:
+            # faiss labels are the passage ids, no id map is stored
+            if os.path.exists(meta_file):
+                os.remove(meta_file)
+        else:
+            np.save(meta_file, self.index_id_to_db_id)
+        # the serialized index includes every update, start a new delta log
+        self.delta_file = os.path.join(dir_path, 'index_delta.log')
+        if os.path.exists(self.delta_file):
+            os.remove(self.delta_file)
+
+    def deserialize_from(self, dir_path, mmap=False):
+        """Load an index saved by `serialize`.
 
-    def deserialize_from(self, dir_path):
+        With `mmap=True` the faiss index and the id map are memory-mapped read-only instead of
+        copied into RAM, so processes loading the same directory share one page-cached copy. Updates
+        in the delta log cannot be replayed onto a read-only index, so an index with pending updates
+        is read into RAM instead until `update_index.py --compact` folds them into `index.faiss`.
+        """
         index_file = os.path.join(dir_path, 'index.faiss')
-        meta_file = os.path.join(dir_path, 'index_meta.faiss')
+        meta_file = os.path.join(dir_path, 'index_meta.npy')
+        legacy_meta_file = os.path.join(dir_path, 'index_meta.faiss')
+        self.delta_file = os.path.join(dir_path, 'index_delta.log')
+        if mmap and os.path.exists(self.delta_file):
+            print(f'{self.delta_file} holds updates that cannot be replayed onto a memory-mapped index, '
+                  f'loading the index into RAM; run update_index.py --compact to memory-map it')
+            mmap = False
         print(f'Loading index from {index_file}, meta data from {meta_file}')
 
-        self.index = faiss.read_index(index_file)
-        print('Loaded index of type %s and size %d', type(self.index), self.index.ntotal)
+        if mmap:
+            # IO_FLAG_MMAP_IFC also maps flat code storage; older faiss only maps ivf inverted lists
+            io_flags = getattr(faiss, 'IO_FLAG_MMAP_IFC', faiss.IO_FLAG_MMAP)
+            self.index = faiss.read_index(index_file, io_flags | faiss.IO_FLAG_READ_ONLY)
+        else:
+            self.index = faiss.read_index(index_file)
+        print(f'Loaded index of type {type(self.index)} and size {self.index.ntotal}')
+
+        self.explicit_ids = False
+        if os.path.exists(meta_file):
+            self.index_id_to_db_id = np.load(meta_file, mmap_mode='r' if mmap else None)
+        elif os.path.exists(legacy_meta_file):
+            # index saved before the id map moved to .npy
+            with open(legacy_meta_file, "rb") as reader:
+                self.index_id_to_db_id = np.asarray(pickle.load(reader), dtype=str)
+        else:
+            self.explicit_ids = True
+        if not self.explicit_ids:
+            assert len(
+                self.index_id_to_db_id) == self.index.ntotal, 'Deserialized index_id_to_db_id should match faiss index size'
+
+        if os.path.exists(self.delta_file):
+            self._replay_delta_log()
+
+    def add(self, ids, embeddings):
+        """Add new passages by id. Only available for indexes built with `explicit_ids=True`."""
+        labels = self._to_labels(ids)
+        duplicates = labels[np.isin(labels, self._stored_labels())]
+        if len(duplicates) > 0:
+            raise ValueError(f'{len(duplicates)} ids are already indexed, e.g. {duplicates[:5].tolist()}; use upsert')
+        self._add_with_ids(labels, embeddings)
+        self._log_update('add', labels, embeddings)
+
+    def remove(self, ids):
+        """Remove passages by id and return the number of vectors removed."""
+        labels = self._to_labels(ids)
+        n_removed = self.index.remove_ids(labels)
+        self._log_update('remove', labels)
+        return n_removed
+
+    def upsert(self, ids, embeddings):
+        """Replace the vectors of passages that are already indexed and add the others."""
+        labels = self._to_labels(ids)
+        self.index.remove_ids(labels)
+        self._add_with_ids(labels, embeddings)
+        self._log_update('upsert', labels, embeddings)
+
+    def _to_labels(self, ids):
+        if not self.explicit_ids:
+            raise ValueError('Index updates by id require an index built with explicit_ids=True')
+        try:
+            return np.asarray(ids).astype('int64')
+        except ValueError:
+            raise ValueError('Explicit-id indexes require integer passage ids')
+
+    def _add_with_ids(self, labels, embeddings):
+        embeddings = np.ascontiguousarray(embeddings, dtype='float32')
+        if not self.index.is_trained:
+            self.train(embeddings)
+        self.index.add_with_ids(embeddings, labels)
+
+    def _stored_labels(self):
+        index = faiss.downcast_index(self.index)
+        if isinstance(index, faiss.IndexIDMap):
+            return faiss.vector_to_array(index.id_map)
+        invlists = faiss.extract_index_ivf(index).invlists
+        labels = [
+            faiss.rev_swig_ptr(invlists.get_ids(list_no), invlists.list_size(list_no)).copy()
+            for list_no in range(invlists.nlist) if invlists.list_size(list_no) > 0
+        ]
+        return np.concatenate(labels) if labels else np.empty(0, dtype='int64')
+
+    def _log_update(self, op, labels, embeddings=None):
+        # updates are appended to a log next to index.faiss and replayed on load until the next serialize
+        if self.delta_file is None:
+            return
+        if embeddings is not None:
+            embeddings = embeddings.astype('float32')
+        with open(self.delta_file, mode='ab') as f:
+            pickle.dump((op, labels, embeddings), f)
 
-        with open(meta_file, "rb") as reader:
-            self.index_id_to_db_id = pickle.load(reader)
-        assert len(
-            self.index_id_to_db_id) == self.index.ntotal, 'Deserialized index_id_to_db_id should match faiss index size'
+    def _replay_delta_log(self):
+        n_updates = 0
+        with open(self.delta_file, 'rb') as reader:
+            while True:
+                try:
+                    op, labels, embeddings = pickle.load(reader)
+                except EOFError:
+                    break
+                except pickle.UnpicklingError:
+                    print(f'Ignoring truncated update at the end of {self.delta_file}')
+                    break
+                if op != 'add':
+                    self.index.remove_ids(labels)
+                if op != 'remove':
+                    self._add_with_ids(labels, embeddings)
+                n_updates += 1
+        print(f'Replayed {n_updates} updates from {self.delta_file}, index size {self.index.ntotal}')
 
     def _update_id_mapping(self, db_ids: List):
-        #new_ids = np.array(db_ids, dtype=np.int64)
-        #self.index_id_to_db_id = np.concatenate((self.index_id_to_db_id, new_ids), axis=0)
-        self.index_id_to_db_id.extend(db_ids)
\ No newline at end of file
+        new_ids = np.asarray(db_ids, dtype=str)
+        self.index_id_to_db_id = np.concatenate((self.index_id_to_db_id, new_ids), axis=0)
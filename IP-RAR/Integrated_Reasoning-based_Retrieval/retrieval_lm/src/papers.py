@@ -0,0 +1,123 @@
+import json
+
+import numpy as np
+
+import src.data
+
+
+def load_passage_pids(passages_path):
+    """Return the sorted passage ids of `passages_path` and the pid (title column) of each."""
+    passage_ids, pids = [], []
+    for passage in src.data.iter_passages(passages_path):
+        passage_ids.append(str(passage["id"]))
+        pids.append(str(passage["title"]))
+    passage_ids, pids = np.array(passage_ids, dtype=str), np.array(pids, dtype=str)
+    order = np.argsort(passage_ids, kind="stable")
+    return passage_ids[order], pids[order]
+
+
+def pids_of(ids, passages_path):
+    """Return the pid of every passage of `ids`, all of which must be in `passages_path`."""
+    passage_ids, pids = load_passage_pids(passages_path)
+    ids = np.asarray(ids, dtype=str)
+    pos = np.minimum(np.searchsorted(passage_ids, ids), len(passage_ids) - 1)
+    found = passage_ids[pos] == ids
+    if not found.all():
+        raise ValueError(f"{(~found).sum()} passages are missing from {passages_path}, e.g. {ids[~found][:5].tolist()}")
+    return pids[pos]
+
+
+def load_pid_list(path):
+    """Read one pid per line."""
+    with open(path) as fin:
+        return [line.strip() for line in fin if line.strip()]
+
+
+def load_paper_years(metadata_path):
+    """Return `{pid: year}` from paper metadata, a .json list or .jsonl file of `Paper` records.
+
+    Records are keyed by their `pid`, or by their `pmid` as in the knowledge graph; records
+    without a year are left out.
+    """
+    with open(metadata_path) as fin:
+        if metadata_path.endswith(".jsonl"):
+            papers = [json.loads(line) for line in fin if line.strip()]
+        else:
+            papers = json.load(fin)
+    years = {}
+    for paper in papers:
+        pid = paper.get("pid", paper.get("pmid"))
+        if pid is not None and paper.get("year") not in (None, ""):
+            years[str(pid)] = int(paper["year"])
+    return years
+
+
+def select_papers(pids, allowed_pids=None, years=None, min_year=None, max_year=None):
+    """Boolean mask of the `pids` in `allowed_pids` published between `min_year` and `max_year`.
+
+    Papers without a known year in `years` fail any year bound.
+    """
+    pids = np.asarray(pids, dtype=str)
+    selected = np.ones(len(pids), dtype=bool)
+    if allowed_pids is not None:
+        selected &= np.isin(pids, np.asarray(list(allowed_pids), dtype=str))
+    if min_year is not None or max_year is not None:
+        # one dict lookup per distinct paper rather than per chunk
+        unique_pids, inverse = np.unique(pids, return_inverse=True)
+        paper_years = np.array([years.get(pid, -1) for pid in unique_pids.tolist()], dtype="int64")[inverse]
+        selected &= paper_years >= 0
+        if min_year is not None:
+            selected &= paper_years >= min_year
+        if max_year is not None:
+            selected &= paper_years <= max_year
+    return selected
+
+
+class PaperLookup(object):
+    """pid of passages by id, as integer codes into the sorted `pids`.
+
+    Built once from the passages file; `codes_of` maps a whole array of hit ids with one
+    `searchsorted`, so results can be grouped by paper without a dict lookup per hit.
+    `sizes[code]` is the number of chunks of a paper.
+    """
+
+    def __init__(self, passages_path):
+        self.passage_ids, passage_pids = load_passage_pids(passages_path)
+        self.pids, self.codes = np.unique(passage_pids, return_inverse=True)
+        self.sizes = np.bincount(self.codes, minlength=len(self.pids))
+
+    def codes_of(self, ids):
+        """Return the paper code of each of `ids`, -1 for unknown or empty ids."""
+        ids = np.asarray(ids, dtype=str)
+        if len(self.passage_ids) == 0:
+            return np.full(ids.shape, -1, dtype="int64")
+        pos = np.minimum(np.searchsorted(self.passage_ids, ids), len(self.passage_ids) - 1)
+        return np.where(self.passage_ids[pos] == ids, self.codes[pos], -1)
+
+
+def distinct_paper_hits(codes, n_papers, chunks_per_paper=1, sizes=None):
+    """Positions of the hits to keep from one ranked hit list with paper `codes` (-1 = no hit).
+
+    Keeps the best `chunks_per_paper` hits of each of the first `n_papers` distinct papers, in rank
+    order. Also returns whether the hits are complete: `n_papers` papers were found, each with
+    `chunks_per_paper` hits or, given the chunk counts `sizes` of all papers, all of its chunks.
+    """
+    valid = np.flatnonzero(codes >= 0)
+    codes = codes[valid]
+    papers, first = np.unique(codes, return_index=True)
+    # papers ranked by their best hit, and the rank of every hit within its paper
+    top_papers = papers[np.argsort(first, kind="stable")[:n_papers]]
+    order = np.argsort(codes, kind="stable")
+    group_starts = np.searchsorted(codes[order], codes[order])
+    rank_in_paper = np.empty(len(codes), dtype="int64")
+    rank_in_paper[order] = np.arange(len(codes)) - group_starts
+    keep = np.isin(codes, top_papers) & (rank_in_paper < chunks_per_paper)
+    complete = len(top_papers) == n_papers
+    if complete and chunks_per_paper > 1:
+        top_papers = np.sort(top_papers)
+        n_kept = np.bincount(np.searchsorted(top_papers, codes[keep]), minlength=len(top_papers))
+        needed = np.full(len(top_papers), chunks_per_paper)
+        if sizes is not None:
+            needed = np.minimum(needed, sizes[top_papers])
+        complete = bool((n_kept >= needed).all())
+    return valid[keep], complete
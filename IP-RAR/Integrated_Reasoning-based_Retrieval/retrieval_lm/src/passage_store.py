@@ -0,0 +1,96 @@
+import os
+import json
+import mmap
+import shutil
+
+import numpy as np
+
+import src.data
+
+
+class PassageStore(object):
+    """Read-only lookup of passages by id, backed by memory-mapped files.
+
+    `passages.jsonl` holds one JSON passage per line, `offsets.npy` the byte offset of every line
+    (plus the end of the file) and `ids.npy`/`order.npy` the sorted passage ids with their line
+    numbers. Opening a store takes the same time for any corpus size, and only the passages that
+    are looked up are read. Supports `store[pid]`, `pid in store`, `store.get(pid)` and `len(store)`
+    like the `passage_id_map` dict it replaces.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.offsets = np.load(os.path.join(store_dir, "offsets.npy"), mmap_mode="r")
+        self.sorted_ids = np.load(os.path.join(store_dir, "ids.npy"), mmap_mode="r")
+        self.order = np.load(os.path.join(store_dir, "order.npy"), mmap_mode="r")
+        with open(os.path.join(store_dir, "passages.jsonl"), "rb") as fin:
+            # mmap keeps its own reference to the file, and cannot map an empty one
+            self.blob = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) if len(self) > 0 else b""
+
+    def __len__(self):
+        return len(self.order)
+
+    def __contains__(self, pid):
+        return self._find(pid) >= 0
+
+    def __getitem__(self, pid):
+        line = self._find(pid)
+        if line < 0:
+            raise KeyError(pid)
+        return self.read_line(line)
+
+    def get(self, pid, default=None):
+        line = self._find(pid)
+        return self.read_line(line) if line >= 0 else default
+
+    def read_line(self, line):
+        return json.loads(self.blob[self.offsets[line]: self.offsets[line + 1]])
+
+    def _find(self, pid):
+        # the last passage wins for repeated ids, as in a dict built from the file
+        pos = np.searchsorted(self.sorted_ids, str(pid), side="right") - 1
+        if pos >= 0 and self.sorted_ids[pos] == str(pid):
+            return int(self.order[pos])
+        return -1
+
+    @staticmethod
+    def build(passages_path, store_dir):
+        """Write the store of a .tsv or .jsonl passages file to `store_dir`."""
+        os.makedirs(store_dir, exist_ok=True)
+        ids, offsets = [], [0]
+        with open(os.path.join(store_dir, "passages.jsonl"), "wb") as fout:
+            for passage in src.data.iter_passages(passages_path):
+                line = (json.dumps(passage, ensure_ascii=False) + "\n").encode("utf-8")
+                fout.write(line)
+                ids.append(str(passage["id"]))
+                offsets.append(offsets[-1] + len(line))
+        ids = np.array(ids, dtype=str)
+        order = np.argsort(ids, kind="stable")
+        np.save(os.path.join(store_dir, "offsets.npy"), np.array(offsets, dtype="int64"))
+        np.save(os.path.join(store_dir, "ids.npy"), ids[order])
+        np.save(os.path.join(store_dir, "order.npy"), order.astype("int64"))
+
+
+def open_passage_store(passages_path, store_dir=None):
+    """Open the store of `passages_path`, (re)building it if it is missing or older than the file.
+
+    The store is kept in `{passages_path}.store` unless `store_dir` is given.
+    """
+    store_dir = store_dir or passages_path + ".store"
+    source = {"path": os.path.abspath(passages_path), "size": os.path.getsize(passages_path),
+              "mtime": os.path.getmtime(passages_path)}
+    meta_path = os.path.join(store_dir, "meta.json")
+    if os.path.exists(meta_path):
+        with open(meta_path) as fin:
+            if json.load(fin) == source:
+                return PassageStore(store_dir)
+    print(f"Building passage store {store_dir} from {passages_path}")
+    # build next to the final location, so a crashed build never looks complete
+    tmp_dir = store_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    PassageStore.build(passages_path, tmp_dir)
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as fout:
+        json.dump(source, fout)
+    shutil.rmtree(store_dir, ignore_errors=True)
+    os.replace(tmp_dir, store_dir)
+    return PassageStore(store_dir)
@@ -93,7 +93,8 @@ def init_distributed_mode(params):
         is_distributed = False
 
     # set GPU device
-    torch.cuda.set_device(params.local_rank)
+    if torch.cuda.is_available():
+        torch.cuda.set_device(params.local_rank)
 
     # initialize multi-GPU
     if is_distributed:
@@ -106,9 +107,11 @@ def init_distributed_mode(params):
         # RANK - required; can be set either here, or in a call to init function
 
         #print("Initializing PyTorch distributed ...")
+        # gloo runs collectives on CPU tensors, for CPU-only nodes
+        backend = getattr(params, 'dist_backend', None) or ('nccl' if torch.cuda.is_available() else 'gloo')
         torch.distributed.init_process_group(
             init_method='env://',
-            backend='nccl',
+            backend=backend,
             #world_size=params.world_size,
             #rank=params.global_rank,
         )
\ No newline at end of file
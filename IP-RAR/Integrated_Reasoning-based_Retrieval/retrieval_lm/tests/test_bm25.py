@@ -0,0 +1,66 @@
+# Run from retrieval_lm with: python -m pytest tests
+
+import csv
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import src.bm25  # noqa: E402
+
+
+def write_corpus(path, n_docs=300, seed=0):
+    rng = np.random.default_rng(seed)
+    # a skewed vocabulary, so that some terms span many blocks and others a single posting
+    words = [f"w{i}" for i in range(60)] + ["il-6", "brca1"]
+    weights = 1.0 / np.arange(1, len(words) + 1)
+    texts = [" ".join(rng.choice(words, rng.integers(1, 40), p=weights / weights.sum())) for _ in range(n_docs)]
+    with open(path, "w", newline="") as fout:
+        writer = csv.writer(fout, delimiter="\t", lineterminator="\n")
+        writer.writerow(["id", "text", "title"])
+        writer.writerows([str(i), text, f"pid{i // 5}"] for i, text in enumerate(texts))
+    return texts
+
+
+def brute_force_scores(texts, query, k1, b):
+    docs = [src.bm25.tokenize(text) for text in texts]
+    doc_lengths = np.array([len(doc) for doc in docs], dtype="float64")
+    avgdl = doc_lengths.mean()
+    scores = np.zeros(len(docs))
+    for term in src.bm25.tokenize(query):
+        tfs = np.array([doc.count(term) for doc in docs], dtype="float64")
+        df = (tfs > 0).sum()
+        idf = np.log(1 + (len(docs) - df + 0.5) / (df + 0.5))
+        scores += idf * tfs * (k1 + 1) / (tfs + k1 * (1 - b + b * doc_lengths / avgdl))
+    return scores
+
+
+def test_search_matches_brute_force(tmp_path):
+    path = str(tmp_path / "passages.tsv")
+    texts = write_corpus(path)
+    k1, b = 0.9, 0.4
+    # small blocks and runs exercise block skipping and the merge of several runs
+    index = src.bm25.BM25Index.build(path, str(tmp_path / "index"), k1=k1, b=b, block_size=4, chunk_postings=97)
+    queries = ["w0 w1", "w3 w17 w17 w42", "il-6 brca1 w5", "w59", "unknown w2", "unknown"]
+    for query in queries:
+        expected = brute_force_scores(texts, query, k1, b)
+        for top_k in (1, 10, 50):
+            docs, scores = index.search(query, top_k)
+            n_hits = min(top_k, int((expected > 0).sum()))
+            assert len(docs) == n_hits
+            np.testing.assert_allclose(scores, np.sort(expected)[::-1][:n_hits], rtol=1e-5)
+            np.testing.assert_allclose(scores, expected[docs], rtol=1e-5)
+
+
+def test_build_does_not_depend_on_chunk_size(tmp_path):
+    path = str(tmp_path / "passages.tsv")
+    write_corpus(path)
+    reference = src.bm25.BM25Index.build(path, str(tmp_path / "reference"), block_size=8)
+    for chunk_postings in (1, 50, 1000):
+        index = src.bm25.BM25Index.build(path, str(tmp_path / f"index_{chunk_postings}"), block_size=8,
+                                         chunk_postings=chunk_postings)
+        assert not os.path.exists(os.path.join(index.index_dir, "runs"))
+        for name in src.bm25.BM25Index.FILES + ("postings",):
+            np.testing.assert_array_equal(getattr(index, name), getattr(reference, name))
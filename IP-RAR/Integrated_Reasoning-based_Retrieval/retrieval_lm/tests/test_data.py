@@ -0,0 +1,57 @@
+# Run from retrieval_lm with: python -m pytest tests
+
+import csv
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import src.data  # noqa: E402
+
+
+def write_tsv(path, rows):
+    with open(path, "w", newline="") as fout:
+        writer = csv.writer(fout, delimiter="\t", lineterminator="\n")
+        writer.writerow(["id", "text", "title"])
+        writer.writerows(rows)
+
+
+def test_shards_split_quoted_multiline_records(tmp_path):
+    rows = []
+    for i in range(200):
+        text = f"chunk {i}"
+        if i % 3 == 0:
+            text += "\nsecond line\n\nthird"
+        if i % 5 == 0:
+            text += ' with "quotes"\tand a tab'
+        rows.append([str(i), text, f"pid{i // 7}"])
+    path = str(tmp_path / "passages.tsv")
+    write_tsv(path, rows)
+
+    full = src.data.load_passages(path)
+    assert [(p["id"], p["text"], p["title"]) for p in full] == [tuple(row) for row in rows]
+    for num_shards in (2, 3, 7, 50):
+        shards = [src.data.load_passages(path, shard_id, num_shards) for shard_id in range(num_shards)]
+        assert [p for shard in shards for p in shard] == full
+        # offsets found in one pass, as handed to the workers of generate_passage_embeddings.py
+        byte_ranges = src.data.shard_byte_ranges(path, num_shards, range(num_shards))
+        assert [src.data.load_passages(path, byte_range=byte_range) for byte_range in byte_ranges] == shards
+
+    size = os.path.getsize(path)
+    positions = list(range(0, size + 1, 97))
+    assert src.data.record_starts(path, positions, quoted=True, block_size=64) == \
+        src.data.record_starts(path, positions, quoted=True)
+
+
+def test_shards_split_jsonl(tmp_path):
+    path = str(tmp_path / "passages.jsonl")
+    with open(path, "w") as fout:
+        for i in range(100):
+            fout.write(json.dumps({"id": str(i), "text": f'a "quoted"\nchunk {i}', "title": "p"}) + "\n")
+
+    full = src.data.load_passages(path)
+    assert len(full) == 100
+    for num_shards in (2, 9):
+        shards = [src.data.load_passages(path, shard_id, num_shards) for shard_id in range(num_shards)]
+        assert [p for shard in shards for p in shard] == full
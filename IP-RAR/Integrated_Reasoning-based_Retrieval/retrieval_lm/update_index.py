@@ -0,0 +1,58 @@
+import argparse
+
+import numpy as np
+
+import src.embeddings
+import src.index
+
+
+def load_embedding_files(embedding_files):
+    allids, allembeddings = [], []
+    for file_path in src.embeddings.glob_embedding_files(embedding_files):
+        print(f"Loading file {file_path}")
+        ids, embeddings = src.embeddings.load_embeddings(file_path)
+        allids.append(ids)
+        allembeddings.append(embeddings)
+    return np.concatenate(allids), np.concatenate(allembeddings, axis=0)
+
+
+def main(args):
+    index = src.index.Indexer(args.projection_size)
+    index.deserialize_from(args.index_dir)
+    if not index.explicit_ids:
+        raise ValueError(f"{args.index_dir} was not built with --explicit_ids and cannot be updated in place")
+
+    if args.remove is not None:
+        with open(args.remove) as fin:
+            ids = [line.strip() for line in fin if line.strip()]
+        print(f"Removed {index.remove(ids)} of {len(ids)} passages.")
+    if args.add is not None:
+        ids, embeddings = load_embedding_files(args.add)
+        index.add(ids, embeddings)
+        print(f"Added {len(ids)} passages.")
+    if args.upsert is not None:
+        ids, embeddings = load_embedding_files(args.upsert)
+        index.upsert(ids, embeddings)
+        print(f"Upserted {len(ids)} passages.")
+    print(f"Index size {index.index.ntotal}.")
+
+    if args.compact:
+        index.serialize(args.index_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--index_dir", type=str, required=True, help="Directory containing index.faiss")
+    parser.add_argument("--add", type=str, default=None, help="Glob path to encoded passages to add")
+    parser.add_argument("--upsert", type=str, default=None, help="Glob path to encoded passages to add or replace")
+    parser.add_argument("--remove", type=str, default=None, help="Text file with one passage id per line to remove")
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Rewrite index.faiss with all updates applied and clear the delta log",
+    )
+    parser.add_argument("--projection_size", type=int, default=768)
+
+    args = parser.parse_args()
+    main(args)